@@ -0,0 +1,692 @@
+"""
+    OmniConf - used with Netbox and Ansible to automate certain device configuration using restconf
+    Copyright (C) 2021, Alexander Birgersson & Rickard Kutsomihas.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+#!/usr/bin/env python
+
+# benchmark of OmniConf without real Netbox and devices
+# webhooks are replayed into the flask app, while a mock Netbox and a mock Restconf device answer the requests of the script
+# run with "python benchmark.py --help" for the options
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import http.server
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Base for the mock servers, keeps the connections open like the real servers do
+    and counts the requests per method and path.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # the request log would drown the report
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, content_type='application/json'):
+        data = json.dumps(body).encode() if body != None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self):
+        # the body has to be read, otherwise it ends up in the next request on the connection
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.server.count(self.command, self.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.answer(body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+
+class NetboxHandler(MockHandler):
+    """
+    Answers the device requests that "get_api_data()" makes to the Netbox API,
+    and the list requests of the index loaded at startup. The generated interfaces and addresses arent listed.
+    """
+
+    def answer(self, body):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        if self.command == 'GET' and parts[:3] == ['api', 'dcim', 'devices'] and len(parts) == 4 and parts[3].isdigit():
+            self.reply(200, device_data(int(parts[3])))
+        elif self.command == 'GET' and parts in (['api', 'dcim', 'devices'], ['api', 'dcim', 'interfaces'], ['api', 'ipam', 'ip-addresses']):
+            query = dict(urllib.parse.parse_qsl(url.query))
+            limit = int(query.get('limit', 50))
+            offset = int(query.get('offset', 0))
+            # every device has changed since the last time, so an update of the index fetches them all again
+            count = self.server.devices if parts[2] == 'devices' else 0
+            results = [device_data(device_id) for device_id in range(offset + 1, min(offset + limit, count) + 1)]
+            following = None
+            if offset + limit < count:
+                following = f'http://127.0.0.1:{self.server.port}{url.path}?limit={limit}&offset={offset + limit}'
+            self.reply(200, {'count': count, 'next': following, 'previous': None, 'results': results})
+        else:
+            self.reply(404, {'detail': 'Not found.'})
+
+
+class DeviceHandler(MockHandler):
+    """
+    Answers Restconf requests like a Cisco IOS XE device, including the cisco-ia save-config RPC and YANG-Patch requests.
+    A share of the requests fail with HTTP 500 when a failure rate is given.
+    """
+
+    def answer(self, body):
+        if self.headers.get('Content-Type') == 'application/yang-patch+json':
+            self.answer_yang_patch(json.loads(body)['ietf-yang-patch:yang-patch'])
+        elif random.random() < self.server.failure_rate:
+            self.reply(500, {'ietf-restconf:errors': {'error': [{'error-type': 'application', 'error-tag': 'operation-failed',
+                                                                 'error-message': 'injected failure'}]}}, 'application/yang-data+json')
+        elif self.path.endswith('/operations/cisco-ia:save-config'):
+            if self.server.save_latency:
+                time.sleep(self.server.save_latency)
+            self.reply(200, {'cisco-ia:output': {'result': 'Save succeeded'}}, 'application/yang-data+json')
+        elif self.command == 'GET' and self.path.endswith('/data/ietf-interfaces:interfaces'):
+            self.reply(200, {'ietf-interfaces:interfaces': {'interface': []}}, 'application/yang-data+json')
+        elif self.command == 'GET' and self.path.endswith('/data/Cisco-IOS-XE-native:native/hostname'):
+            self.reply(200, {'Cisco-IOS-XE-native:hostname': 'benchmark'}, 'application/yang-data+json')
+        elif self.command == 'GET':
+            # the restconf_config module reads the path before it writes to it
+            self.reply(200, {}, 'application/yang-data+json')
+        else:
+            self.reply(204)
+
+    # the first edit fails when the patch fails, which means none of the edits are applied
+    def answer_yang_patch(self, patch):
+        for edit in patch['edit']:
+            message = yang_patch_error(edit)
+            if message != None:
+                error = {'error-type': 'protocol', 'error-tag': 'invalid-value', 'error-message': message}
+                status = {'patch-id': patch['patch-id'], 'edit-status': {'edit': [{'edit-id': edit['edit-id'], 'errors': {'error': [error]}}]}}
+                self.reply(400, {'ietf-yang-patch:yang-patch-status': status}, 'application/yang-data+json')
+                return
+        if random.random() < self.server.failure_rate:
+            error = {'error-type': 'application', 'error-tag': 'operation-failed', 'error-message': 'injected failure'}
+            status = {'patch-id': patch['patch-id'], 'edit-status': {'edit': [{'edit-id': patch['edit'][0]['edit-id'], 'errors': {'error': [error]}}]}}
+            self.reply(409, {'ietf-yang-patch:yang-patch-status': status}, 'application/yang-data+json')
+        else:
+            self.reply(200, {'ietf-yang-patch:yang-patch-status': {'patch-id': patch['patch-id'], 'ok': [None]}}, 'application/yang-data+json')
+
+
+# what a device would reject in the edit of a YANG-Patch, or "None" when the edit is valid
+# the members of the value have to be named "module:node" and a list entry needs the key of its target
+def yang_patch_error(edit):
+    if 'value' not in edit:
+        return None
+    for member, value in edit['value'].items():
+        module, _, node = member.partition(':')
+        if not module or not node or ':' in node:
+            return f'unknown member {member!r}'
+        last = edit['target'].rsplit('/', 1)[-1]
+        if '=' in last:
+            if last.split('=')[0].split(':')[-1] != node or not isinstance(value, list) or len(value) != 1:
+                return f'{member!r} is not the entry of {edit["target"]!r}'
+            if value[0].get('name') != urllib.parse.unquote(last.split('=', 1)[1]):
+                return f'the key of {member!r} doesnt match {edit["target"]!r}'
+    return None
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    """A mock server listening on a free port of 127.0.0.1, served by a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0, save_latency=0, failure_rate=0):
+        super(MockServer, self).__init__(('127.0.0.1', 0), handler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.save_latency = save_latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        # (method, path) -> number of requests
+        self.requests = collections.Counter()
+
+    def count(self, method, path):
+        with self.lock:
+            self.requests[(method, path)] += 1
+
+    def total(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+# a port on 127.0.0.1 that is free right now
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+# the primary ip of the generated device with the given id
+def device_ip(device_id):
+    return f'10.{(device_id >> 16) & 255}.{(device_id >> 8) & 255}.{device_id & 255}'
+
+
+# the device as returned by the Netbox API and included in the device webhook
+def device_data(device_id):
+    return {
+           'id': device_id,
+           'url': f'/api/dcim/devices/{device_id}/',
+           'name': f'switch {device_id}',
+           'display_name': f'switch {device_id}',
+           'primary_ip': {'id': device_id, 'family': 4, 'address': device_ip(device_id) + '/24'},
+           'primary_ip4': {'id': device_id, 'family': 4, 'address': device_ip(device_id) + '/24'},
+           'primary_ip6': None
+           }
+
+
+class WebhookGenerator:
+    """
+    Generates Netbox webhooks in the format of Netbox 2.11 for the device, interface and ipaddress models,
+    with the created, updated and deleted events handled by "respond()".
+    Keeps track of the generated interfaces and addresses, so the snapshots are consistent with each other.
+    """
+
+    def __init__(self, devices, seed=None):
+        self.random = random.Random(seed)
+        self.devices = devices
+        self.ids = collections.defaultdict(int)
+        # device id -> {interface id -> interface}, the interface includes its address
+        self.interfaces = {device_id: {} for device_id in range(1, devices + 1)}
+
+    def next_id(self, kind):
+        self.ids[kind] += 1
+        return self.ids[kind]
+
+    def webhook(self, model, event, data, prechange, postchange):
+        return {
+               'event': event,
+               'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'model': model,
+               'username': 'benchmark',
+               'request_id': str(uuid.uuid4()),
+               'data': data,
+               'snapshots': {'prechange': prechange, 'postchange': postchange}
+               }
+
+    def interface_data(self, device_id, interface):
+        device = {'id': device_id, 'url': f'/api/dcim/devices/{device_id}/', 'name': f'switch {device_id}'}
+        return {
+               'id': interface['id'],
+               'url': f"/api/dcim/interfaces/{interface['id']}/",
+               'device': device,
+               'name': interface['name'],
+               'type': {'value': 'virtual', 'label': 'Virtual'},
+               'enabled': interface['enabled'],
+               'description': interface['description']
+               }
+
+    def interface_snapshot(self, device_id, interface):
+        return {'device': device_id, 'name': interface['name'], 'type': 'virtual',
+                'enabled': interface['enabled'], 'description': interface['description']}
+
+    def address_data(self, device_id, interface, address):
+        assigned = {'id': interface['id'], 'url': f"/api/dcim/interfaces/{interface['id']}/", 'name': interface['name'],
+                    'device': {'id': device_id, 'url': f'/api/dcim/devices/{device_id}/', 'name': f'switch {device_id}'}}
+        return {
+               'id': interface['id'],
+               'url': f"/api/ipam/ip-addresses/{interface['id']}/",
+               'family': {'value': 4, 'label': 'IPv4'},
+               'address': address,
+               'assigned_object_type': 'dcim.interface',
+               'assigned_object_id': interface['id'],
+               'assigned_object': assigned
+               }
+
+    def address_snapshot(self, interface, address):
+        return {'address': address, 'assigned_object_type': 40, 'assigned_object_id': interface['id'], 'status': 'active'}
+
+    def new_address(self):
+        number = self.next_id('address')
+        return f'172.{16 + (number >> 16) % 16}.{(number >> 8) & 255}.{number & 255}/32'
+
+    # returns the next webhook
+    def next(self):
+        device_id = self.random.randint(1, self.devices)
+        interfaces = self.interfaces[device_id]
+        choice = self.random.random()
+
+        if not interfaces or choice < 0.2:
+            interface = {'id': self.next_id('interface'), 'enabled': True, 'description': '', 'address': None}
+            interface['name'] = f"Loopback{interface['id']}"
+            interfaces[interface['id']] = interface
+            snapshot = self.interface_snapshot(device_id, interface)
+            return self.webhook('interface', 'created', self.interface_data(device_id, interface), None, snapshot)
+
+        interface = interfaces[self.random.choice(list(interfaces))]
+
+        if choice < 0.5:
+            prechange = self.interface_snapshot(device_id, interface)
+            interface['description'] = f'benchmark {self.next_id("description")}'
+            interface['enabled'] = self.random.random() < 0.9
+            postchange = self.interface_snapshot(device_id, interface)
+            return self.webhook('interface', 'updated', self.interface_data(device_id, interface), prechange, postchange)
+
+        if choice < 0.6:
+            # the device is renamed back to its generated name
+            prechange = {'name': 'renamed', 'primary_ip4': device_id}
+            postchange = {'name': f'switch {device_id}', 'primary_ip4': device_id}
+            return self.webhook('device', 'updated', device_data(device_id), prechange, postchange)
+
+        if interface['address'] == None:
+            interface['address'] = self.new_address()
+            snapshot = self.address_snapshot(interface, interface['address'])
+            return self.webhook('ipaddress', 'created', self.address_data(device_id, interface, interface['address']), None, snapshot)
+
+        if choice < 0.85:
+            prechange = self.address_snapshot(interface, interface['address'])
+            interface['address'] = self.new_address()
+            postchange = self.address_snapshot(interface, interface['address'])
+            return self.webhook('ipaddress', 'updated', self.address_data(device_id, interface, interface['address']), prechange, postchange)
+
+        if choice < 0.95:
+            prechange = self.address_snapshot(interface, interface['address'])
+            data = self.address_data(device_id, interface, interface['address'])
+            interface['address'] = None
+            return self.webhook('ipaddress', 'deleted', data, prechange, None)
+
+        prechange = self.interface_snapshot(device_id, interface)
+        del interfaces[interface['id']]
+        return self.webhook('interface', 'deleted', self.interface_data(device_id, interface), prechange, None)
+
+
+# writes an Ansible inventory where every generated device connects to the mock device
+def write_inventory(directory, devices, port):
+    path = os.path.join(directory, 'hosts')
+    with open(path, 'w') as inventory:
+        inventory.write('[devices]\n')
+        for device_id in range(1, devices + 1):
+            inventory.write(f'{device_ip(device_id)} ansible_host=127.0.0.1\n')
+        inventory.write('\n[all:vars]\n'
+                        'ansible_connection=ansible.netcommon.httpapi\n'
+                        'ansible_network_os=ansible.netcommon.restconf\n'
+                        'ansible_user=benchmark\n'
+                        'ansible_httpapi_password=benchmark\n'
+                        f'ansible_httpapi_port={port}\n'
+                        'ansible_httpapi_use_ssl=no\n'
+                        'ansible_httpapi_validate_certs=no\n')
+    return path
+
+
+# returns the "p"th percentile of the sorted values
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def latency_summary(values):
+    values = sorted(values)
+    return {'p50': percentile(values, 50) * 1000, 'p95': percentile(values, 95) * 1000, 'p99': percentile(values, 99) * 1000}
+
+
+def run(args):
+    """
+    Replays the webhooks into the flask app and waits until all accepted jobs are done.
+    Returns the report as a dict.
+    """
+
+    netbox = MockServer(NetboxHandler, latency=args.netbox_latency / 1000)
+    netbox.devices = args.devices
+    netbox.start()
+    device = MockServer(DeviceHandler, latency=args.device_latency / 1000,
+                        save_latency=args.save_latency / 1000, failure_rate=args.failure_rate).start()
+    directory = tempfile.mkdtemp(prefix='omniconf-benchmark-')
+    inventory = write_inventory(directory, args.devices, device.port)
+
+    # the script is imported after the mock servers are up, the settings are pointed at them
+    import main as omniconf
+    omniconf.NETBOX_IP = f'http://127.0.0.1:{netbox.port}'
+    omniconf.EXECUTOR = args.executor
+    omniconf.ansible_runtime.sources = inventory
+    # a fresh journal, the jobs of a real deployment are never replayed against the mocks
+    omniconf.journal.path = os.path.join(directory, 'journal.db') if args.journal else ''
+
+    # the index is loaded before the webhooks are sent, like after a restart that has been up for a moment
+    if args.index:
+        omniconf.netbox_index.start()
+        omniconf.netbox_index.ready.wait(60)
+    else:
+        omniconf.NETBOX_INDEX = False
+    # the requests of the startup arent made per webhook
+    netbox_startup = netbox.total()
+
+    # the shards are separate processes, they join a router serving the flask app on a free port
+    shards = []
+    if args.shards:
+        from werkzeug.serving import make_server
+        # the shard path is only served with a token, the shards get it through the environment
+        omniconf.SHARD_TOKEN = omniconf.SHARD_TOKEN or uuid.uuid4().hex
+        omniconf.enable_sharding()
+        router = make_server('127.0.0.1', 0, omniconf.app, threaded=True)
+        threading.Thread(target=router.serve_forever, daemon=True).start()
+        output = None if args.verbose else subprocess.DEVNULL
+        for i in range(args.shards):
+            port = free_port()
+            shards.append(subprocess.Popen([sys.executable, os.path.abspath(omniconf.__file__), 'shard', '--host', '127.0.0.1', '--port', str(port),
+                                            '--router', f'http://127.0.0.1:{router.server_port}', '--advertise', f'http://127.0.0.1:{port}',
+                                            '--executor', args.executor, '--inventory', inventory], stdout=output, stderr=output,
+                                           env=dict(os.environ, OMNICONF_SHARD_TOKEN=omniconf.SHARD_TOKEN)))
+        deadline = time.monotonic() + 60
+        while len(omniconf.shard_ring.nodes()) < args.shards and time.monotonic() < deadline:
+            time.sleep(0.1)
+    if args.coalesce_window != None:
+        omniconf.coalescer.window = args.coalesce_window
+    if args.save_quiet_window != None:
+        omniconf.save_debouncer.quiet = args.save_quiet_window
+    if not args.dedup:
+        omniconf.webhook_dedup.window = 0
+    if args.fanout_size != None:
+        omniconf.FANOUT_SIZE = args.fanout_size
+        omniconf.coalescer.fanout_size = args.fanout_size
+
+    if args.replay:
+        with open(args.replay) as replay:
+            webhooks = [json.loads(line) for line in replay if line.strip()]
+    else:
+        generator = WebhookGenerator(args.devices, args.seed)
+        webhooks = [generator.next() for i in range(args.count)]
+
+    if args.retry_rate:
+        # netbox delivers a webhook again when the response to it timed out
+        retries = random.Random(args.seed)
+        delivered = []
+        for webhook in webhooks:
+            delivered.append(webhook)
+            if retries.random() < args.retry_rate:
+                delivered.append(webhook)
+        webhooks = delivered
+
+    lock = threading.Lock()
+    done = threading.Condition(lock)
+    acks = []
+    statuses = collections.Counter()
+    end_to_end = []
+    # jobs whose tasks failed, e.g. a patch the mock device rejected
+    failed = []
+
+    def job_finished(jobs, results):
+        now = time.monotonic()
+        with done:
+            for job in jobs:
+                if 'received' in job:
+                    end_to_end.append(now - job['received'])
+            if results != None and (results['failed'] or results['unreachable']):
+                failed.extend(jobs)
+            done.notify_all()
+
+    omniconf.job_listeners.append(job_finished)
+
+    clients = threading.local()
+
+    # posts the webhook to the asgi app, the way an asgi server would
+    async def post_asgi(body):
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST', 'path': omniconf.FLASK_PATH, 'headers': [(b'content-type', b'application/json')]}
+        await omniconf.asgi_app(scope, receive, send)
+        return sent[0]['status']
+
+    if args.server == 'asgi':
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    def send(webhook):
+        body = json.dumps(webhook).encode()
+        started = time.monotonic()
+        if args.server == 'asgi':
+            status = asyncio.run_coroutine_threadsafe(post_asgi(body), loop).result()
+        else:
+            if not hasattr(clients, 'client'):
+                clients.client = omniconf.app.test_client()
+            status = clients.client.post(omniconf.FLASK_PATH, data=body, content_type='application/json').status_code
+        with lock:
+            acks.append(time.monotonic() - started)
+            statuses[status] += 1
+
+    output = open(os.devnull, 'w') if not args.verbose else None
+    with contextlib.ExitStack() as stack:
+        if output:
+            stack.enter_context(output)
+            stack.enter_context(contextlib.redirect_stdout(output))
+
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.clients) as pool:
+            futures = []
+            for i, webhook in enumerate(webhooks):
+                if args.rate:
+                    # keeps the given rate of webhooks per second
+                    delay = started + i / args.rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(pool.submit(send, webhook))
+            for future in futures:
+                future.result()
+        sent = time.monotonic()
+
+        # every accepted webhook results in a finished job
+        deadline = sent + args.timeout
+        with done:
+            while len(end_to_end) < statuses[202] and time.monotonic() < deadline:
+                done.wait(deadline - time.monotonic())
+        finished = time.monotonic()
+
+        # the saves still waiting for the quiet window are done now, so they are part of the device calls
+        omniconf.save_debouncer.flush()
+
+    omniconf.job_listeners.remove(job_finished)
+    # the shards save the pending configurations when they stop
+    for shard in shards:
+        shard.terminate()
+    for shard in shards:
+        shard.wait()
+    if args.server == 'asgi':
+        loop.call_soon_threadsafe(loop.stop)
+    netbox.shutdown()
+    device.shutdown()
+
+    saves = sum(count for (method, path), count in device.requests.items() if path.endswith('cisco-ia:save-config'))
+    return {
+           'webhooks': len(webhooks),
+           'shards': len(shards),
+           'statuses': {str(status): count for status, count in sorted(statuses.items())},
+           'jobs_finished': len(end_to_end),
+           'jobs_failed': len(failed),
+           'seconds': round(finished - started, 3),
+           'webhooks_per_second': round(len(webhooks) / max(sent - started, 0.001), 1),
+           'jobs_per_second': round(len(end_to_end) / max(finished - started, 0.001), 1),
+           'ack_ms': latency_summary(acks),
+           'end_to_end_ms': latency_summary(end_to_end),
+           'netbox_calls_per_webhook': round((netbox.total() - netbox_startup) / max(len(webhooks), 1), 3),
+           'device_calls_per_webhook': round(device.total() / max(len(webhooks), 1), 3),
+           'saves_per_webhook': round(saves / max(len(webhooks), 1), 3)
+           }
+
+
+def startup(args, runs=5):
+    """
+    Measures how soon a (re)started script answers webhooks, which is how long Netbox deliveries fail during a restart.
+    The import of the script and the import of Ansible, which is done by the first job, are timed in new processes.
+    "main.py serve" is then started until it answers a generated webhook.
+    Every measurement is done "runs" times, returns the medians as a dict.
+    """
+
+    import main as omniconf
+    script = os.path.abspath(omniconf.__file__)
+    # the journal of the started scripts is written here
+    directory = tempfile.mkdtemp(prefix='omniconf-startup-')
+    timer = (f'import sys, time; sys.path.insert(0, {os.path.dirname(script)!r}); started = time.perf_counter(); import main; '
+             'imported = time.perf_counter(); main.import_ansible(); print(imported - started, time.perf_counter() - imported)')
+    body = json.dumps(WebhookGenerator(1, args.seed).next()).encode()
+
+    imports = []
+    ansible_imports = []
+    answers = []
+    statuses = collections.Counter()
+    for i in range(runs):
+        output = subprocess.run([sys.executable, '-c', timer], cwd=directory, capture_output=True, text=True, check=True).stdout
+        script_seconds, ansible_seconds = output.split('\n')[-2].split()
+        imports.append(float(script_seconds))
+        ansible_imports.append(float(ansible_seconds))
+
+        port = free_port()
+        started = time.monotonic()
+        process = subprocess.Popen([sys.executable, script, 'serve', '--host', '127.0.0.1', '--port', str(port)], cwd=directory,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # the webhook is sent again until the script is listening
+            while time.monotonic() - started < args.timeout:
+                webhook = urllib.request.Request(f'http://127.0.0.1:{port}{omniconf.FLASK_PATH}', data=body, headers={'Content-type': 'application/json'})
+                try:
+                    with urllib.request.urlopen(webhook, timeout=args.timeout) as response:
+                        status = response.status
+                except urllib.error.HTTPError as error:
+                    status = error.code
+                except OSError:
+                    time.sleep(0.01)
+                    continue
+                answers.append(time.monotonic() - started)
+                statuses[status] += 1
+                break
+        finally:
+            process.terminate()
+            process.wait()
+
+    return {
+           'runs': runs,
+           'statuses': {str(status): count for status, count in sorted(statuses.items())},
+           'import_ms': percentile(sorted(imports), 50) * 1000,
+           'ansible_import_ms': percentile(sorted(ansible_imports), 50) * 1000,
+           'first_answer_ms': percentile(sorted(answers), 50) * 1000 if answers else 0
+           }
+
+
+def print_startup(report):
+    print('STARTUP *********')
+    print(f"runs: {report['runs']}, first answers: {report['statuses']}")
+    print(f"{'import main (ms)':<24}{report['import_ms']:>12.2f}")
+    # imported by the first job, or at startup when LAZY_IMPORTS is off
+    print(f"{'import Ansible (ms)':<24}{report['ansible_import_ms']:>12.2f}")
+    print(f"{'first answer (ms)':<24}{report['first_answer_ms']:>12.2f}")
+
+
+# prints the report, with the change against the baseline when given
+def print_report(report, baseline=None):
+    print('BENCHMARK *********')
+    print(f"webhooks: {report['webhooks']} {report['statuses']}, jobs finished: {report['jobs_finished']} ({report['jobs_failed']} failed) in {report['seconds']} s, shards: {report.get('shards', 0)}")
+
+    rows = [('webhooks/s', ('webhooks_per_second',)), ('jobs/s', ('jobs_per_second',))]
+    for name in ('ack_ms', 'end_to_end_ms'):
+        for p in ('p50', 'p95', 'p99'):
+            rows.append((f'{name[:-3]} {p} (ms)', (name, p)))
+    rows += [('netbox calls/webhook', ('netbox_calls_per_webhook',)),
+             ('device calls/webhook', ('device_calls_per_webhook',)),
+             ('saves/webhook', ('saves_per_webhook',))]
+
+    for name, keys in rows:
+        value = report
+        for key in keys:
+            value = value[key]
+        line = f'{name:<24}{value:>12.2f}'
+        if baseline != None:
+            old = baseline
+            for key in keys:
+                old = old[key]
+            change = (value - old) / old * 100 if old else 0
+            line += f'{old:>12.2f}{change:>+10.1f}%'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays webhooks into OmniConf against a mock Netbox and a mock Restconf device')
+    parser.add_argument('--count', type=int, default=500, help='number of generated webhooks')
+    parser.add_argument('--devices', type=int, default=20, help='number of generated devices')
+    parser.add_argument('--replay', help='file with recorded webhooks to replay instead, one json object per line')
+    parser.add_argument('--rate', type=float, default=0, help='webhooks per second (0 = as fast as possible)')
+    parser.add_argument('--clients', type=int, default=8, help='number of webhooks sent at the same time')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the generated webhooks')
+    parser.add_argument('--executor', choices=['ansible', 'restconf', 'yang-patch'], default='restconf')
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='flask', help='the app the webhooks are sent to')
+    parser.add_argument('--no-index', dest='index', action='store_false', help='leaves out the index of the devices loaded from netbox at startup')
+    parser.add_argument('--shards', type=int, default=0, help='number of shard processes the devices are spread across')
+    parser.add_argument('--coalesce-window', type=float, help='overrides COALESCE_WINDOW')
+    parser.add_argument('--save-quiet-window', type=float, help='overrides SAVE_QUIET_WINDOW')
+    parser.add_argument('--fanout-size', type=int, help='overrides FANOUT_SIZE')
+    parser.add_argument('--no-journal', dest='journal', action='store_false', help='accepts the webhooks without writing them to a journal')
+    parser.add_argument('--netbox-latency', type=float, default=5, help='latency of the mock Netbox in ms')
+    parser.add_argument('--device-latency', type=float, default=20, help='latency of the mock device in ms')
+    parser.add_argument('--save-latency', type=float, default=500, help='extra latency of save-config in ms')
+    parser.add_argument('--retry-rate', type=float, default=0, help='share of webhooks delivered twice, like netbox does after a timeout, 0-1')
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false', help='executes the webhooks delivered twice again')
+    parser.add_argument('--failure-rate', type=float, default=0, help='share of device requests that fail, 0-1')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for the jobs to finish')
+    parser.add_argument('--baseline', help='report of an earlier run to compare with')
+    parser.add_argument('--save', help='writes the report to this file, to be used as a baseline')
+    parser.add_argument('--verbose', action='store_true', help='keeps the output of the script')
+    parser.add_argument('--startup', action='store_true', help='measures the import time and how soon a started script answers a webhook instead')
+    args = parser.parse_args()
+
+    if args.startup:
+        print_startup(startup(args))
+        sys.exit()
+
+    report = run(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(report, save_file, indent=4)
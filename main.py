@@ -22,23 +22,90 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import argparse
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import hashlib
+import hmac
 import json
+import logging
+import os
+import queue
+import secrets
 import shutil
-
-import ansible.constants as C
-from ansible.executor.task_queue_manager import TaskQueueManager
-from ansible.module_utils.common.collections import ImmutableDict
-from ansible.inventory.manager import InventoryManager
-from ansible.parsing.dataloader import DataLoader
-from ansible.playbook.play import Play
-from ansible.plugins.callback import CallbackBase
-from ansible.vars.manager import VariableManager
-from ansible import context
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+
+# the Ansible API (to run playbooks) takes longer to import than the rest of the script,
+# it is imported by "import_ansible()" when the first job needs it, see "LAZY_IMPORTS"
+C = None
+TaskQueueManager = None
+ImmutableDict = None
+InventoryManager = None
+DataLoader = None
+Play = None
+CallbackBase = None
+HostVars = None
+VariableManager = None
+context = None
+init_plugin_loader = None
+ResultsCollectorJSONCallback = None
+ansible_import_lock = threading.Lock()
+
+
+def import_ansible():
+    global C, TaskQueueManager, ImmutableDict, InventoryManager, DataLoader, Play, CallbackBase, HostVars, VariableManager, context
+    global init_plugin_loader, ResultsCollectorJSONCallback
+    with ansible_import_lock:
+        if ResultsCollectorJSONCallback != None:
+            return
+        started = time.perf_counter()
+        import ansible.constants as C
+        from ansible.executor.task_queue_manager import TaskQueueManager
+        from ansible.module_utils.common.collections import ImmutableDict
+        from ansible.inventory.manager import InventoryManager
+        from ansible.parsing.dataloader import DataLoader
+        from ansible.playbook.play import Play
+        from ansible.plugins.callback import CallbackBase
+        from ansible.vars.hostvars import HostVars
+        from ansible.vars.manager import VariableManager
+        from ansible import context
+        try:
+            from ansible.plugins.loader import init_plugin_loader
+        except ImportError:
+            # before ansible-core 2.15 the plugin loader was initialized when imported
+            init_plugin_loader = None
+
+        # Ansible only accepts a callback which is a CallbackBase
+        class ResultsCollectorJSONCallback(ResultsCollector, CallbackBase):
+            pass
+
+        print('Ansible imported in {0:.2f} s'.format(time.perf_counter() - started))
+
+# parses the webhooks several times faster than the json module, when installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
 
 # the imports needed for flask and HTTP requests
 from flask import Flask, request, Response              # used for flask app, receive and response of webhook
 import requests                                         # used for HTTP get request to netbox api
 from requests.auth import HTTPBasicAuth                 # used for creating the basic authentication field in the HTTP header
+from requests.adapters import HTTPAdapter               # used for sizing the connection pools of the HTTP sessions
 app = Flask(__name__)
 
 # IMPORTANT: YOUR user specific settings:
@@ -47,6 +114,62 @@ NETBOX_IP = 'https://X.X.X.X'                                               # ip
 NETBOX_TOKEN = 'Token c788f875f6a0bce55f485051a61dbb67edba0994'             # user token to be able to communicate with netbox api
 ANSIBLE_INVFILE = '/home/albiriku/devnet/dne-dna-code/intro-ansible/hosts'  # path to Ansible inventory file
 ANSIBLE_VAULTPASS = 'secret'                                                # ansible vault password for decryption
+WORKER_COUNT = 4                                                            # number of worker threads that send configuration to the devices
+JOB_QUEUE_SIZE = 1000                                                       # max number of waiting jobs, webhooks are refused with HTTP 503 when full (0 = unlimited)
+DEDUP_WINDOW = 300                                                          # seconds a webhook is remembered, the same webhook delivered again by netbox within this time is dropped (0 = no deduplication)
+DEDUP_SIZE = 65536                                                          # max number of webhooks remembered for the deduplication
+IP_CACHE_SIZE = 4096                                                        # max number of devices whose primary ip address is cached
+IP_CACHE_TTL = 3600                                                         # seconds a cached primary ip address is trusted without asking netbox again
+CREDENTIAL_CACHE_SIZE = 4096                                                # max number of devices whose connection details and credentials are kept after reading them from the var files
+HTTP_TIMEOUT = (5, 30)                                                      # connect and read timeout in seconds for HTTP requests to netbox and the devices
+HTTP_KEEPALIVE = True                                                       # keeps the HTTP connections to netbox and the devices open between requests
+NETBOX_POOL_SIZE = 10                                                       # max number of open connections to netbox
+DEVICE_POOL_SIZE = 2                                                        # max number of open connections to each device
+DEVICE_SESSIONS = 256                                                       # max number of devices with open connections, the least recently used are closed
+SAVE_QUIET_WINDOW = 2                                                       # seconds without changes to a device before its configuration is saved to startup-config
+SAVE_MAX_DELAY = 30                                                         # max seconds a save of the configuration is postponed by new changes
+NETBOX_INDEX = True                                                         # loads the primary ip address of every device from netbox at startup, instead of asking for it per webhook
+NETBOX_INDEX_REFRESH = 60                                                   # seconds between fetching the devices and ip addresses changed in netbox since the last time
+DIFF_BEFORE_PUSH = False                                                    # reads the configuration of the device first and only sends the changes it doesnt already have
+DEVICE_STATE_TTL = 300                                                      # seconds the configuration read from a device is trusted
+EXECUTOR = 'ansible'                                                        # 'ansible' runs the tasks as an Ansible play, 'restconf' sends them directly to the device, 'yang-patch' sends them as one YANG-Patch request
+ANSIBLE_RELOAD_INTERVAL = 5                                                 # seconds between checks if the inventory or var files have changed on disk
+ANSIBLE_FORKS = 0                                                           # max number of devices a play configures at the same time (0 = 4 per cpu core)
+FANOUT_SIZE = 50                                                            # max number of devices whose gathered tasks are executed as one Ansible play (1 = a play per device)
+FANOUT_WAIT = 0.05                                                          # seconds to wait for the windows of other devices to close, so their tasks go into the same play
+SYNC_CONCURRENCY = 20                                                       # max number of tasks sent to the devices at the same time during a sync
+SYNC_DEVICE_CONCURRENCY = 2                                                 # max number of tasks sent to the same device at the same time during a sync
+SYNC_CHUNK_SIZE = 20                                                        # max number of tasks sent to a device as one play during a sync
+SYNC_PAGE_SIZE = 1000                                                       # number of objects fetched from the netbox api per request during a sync
+SYNC_DEVICE_BATCH = 100                                                     # number of devices whose ip addresses are fetched per query when syncing a site
+COALESCE_WINDOW = 0.5                                                       # seconds to gather changes to the same device into one play and one save-config (0 = no waiting)
+COMPACT_EVENTS = True                                                       # folds the changes to the same object gathered in the coalesce window into their net effect
+BREAKER_THRESHOLD = 3                                                       # failed plays in a row that stop the changes to a device for a while, an unreachable device is stopped right away
+BREAKER_BACKOFF = 5                                                         # seconds before checking if a stopped device is back, doubled after every check it isnt
+BREAKER_MAX_BACKOFF = 300                                                   # max seconds between the checks if a stopped device is back
+DEVICE_RATE = 2                                                             # plays and saves started per second on a device at first, adapted to how the device responds (0 = no limit)
+DEVICE_MAX_RATE = 20                                                        # max plays and saves started per second on a device
+DEVICE_CONCURRENCY = 1                                                      # plays and saves running on a device at the same time at first, adapted to how the device responds
+DEVICE_MAX_CONCURRENCY = 4                                                  # max plays and saves running on a device at the same time
+DEVICE_SLOW_FACTOR = 3                                                      # a play or save this many times slower than usual for the device lowers its limits, like a failure does
+TOTAL_CONCURRENCY = 64                                                      # max plays and saves running at the same time across all devices (0 = no limit)
+SHARDS = []                                                                 # urls of shard processes the devices are spread across, e.g. ['http://10.0.0.2:5101'] (empty = executed in this process)
+SHARD_PATH = '/shard'                                                       # the path the shards and the router talk to each other on
+SHARD_TOKEN = ''                                                            # shared secret the shards and the router send each other, required for sharding ('' = no shard path)
+SHARD_VNODES = 100                                                          # points per shard on the hash ring, more points spread the devices more evenly
+SHARD_HEARTBEAT = 10                                                        # seconds between a shard telling the router it is still there, so it rejoins after a restart of either
+SHARD_TIMEOUT = 600                                                         # max seconds a shard may take to execute the tasks for a device
+METRICS_PATH = '/metrics'                                                   # the path that flask serves the prometheus metrics on
+DEBUG_LOG = False                                                           # logs the full webhooks and responses, which is slow for large bursts of webhooks
+JOURNAL_PATH = 'omniconf-journal.db'                                       # sqlite file the accepted webhooks are written to before they are acknowledged ('' = no journal)
+JOURNAL_COMPACT_INTERVAL = 60                                               # seconds between removing the finished jobs from the journal
+LAZY_IMPORTS = True                                                         # imports Ansible when the first job needs it instead of at startup, so webhooks are answered sooner after a (re)start
+
+# the full webhooks and responses are logged at debug level
+logger = logging.getLogger('omniconf')
+if DEBUG_LOG:
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG)
 
 # "configurable" contains the values from the webhook we deem are configurationable for the corresponding model 
 # "informational" contains additional information required for configuration
@@ -69,6 +192,93 @@ list_of_models =    {
                     }
 
 
+# the metrics are served on "METRICS_PATH" in the prometheus text format
+# label values are escaped as the format requires
+def format_labels(names, values):
+    labels = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        labels.append(f'{name}="{value}"')
+    return ','.join(labels)
+
+
+class Histogram:
+    """
+    A prometheus histogram with labels, e.g. the time spent in each stage of handling a webhook.
+    Values are observed with "observe()" or by timing a block of code with "time()".
+    """
+
+    def __init__(self, name, documentation, labels, buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [count per bucket, sum, count]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series == None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.series.items()):
+                labels = format_labels(self.labels, label_values)
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {bucket}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{labels}}} {total}')
+                lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+class Gauge:
+    """
+    A prometheus gauge whose values are read when the metrics are served.
+    "function" returns a dict with a tuple of label values as key and the value of the gauge as value.
+    """
+
+    def __init__(self, name, documentation, labels, function):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.function = function
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for label_values, value in sorted(self.function().items()):
+            if label_values:
+                lines.append(f'{self.name}{{{format_labels(self.labels, label_values)}}} {value}')
+            else:
+                lines.append(f'{self.name} {value}')
+        return lines
+
+
+# the time spent in each stage, labelled by the model and event of the webhook and the device
+# the labels are left empty when they arent known in the stage, e.g. the device before "get_api_data()"
+stage_seconds = Histogram('omniconf_stage_seconds', 'Time spent in each stage of handling a webhook.', ('stage', 'model', 'event', 'device'))
+
+# every metric served on "METRICS_PATH"
+metrics = [stage_seconds]
+
+
 # check if "model" is configurable and returns "True" if match
 def check_model(model):
     if model in list_of_models:
@@ -157,17 +367,298 @@ def pick_out_values(model, data, values):
     return None
 
 
+# creates a HTTP session which reuses its connections, sessions can be shared between the worker threads
+def create_session(pool_size, hosts=1):
+    session = requests.Session()
+    # "hosts" is the number of hosts the session keeps connections to
+    adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.verify = False
+    if not HTTP_KEEPALIVE:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+# the session used for the netbox api
+netbox_session = create_session(NETBOX_POOL_SIZE)
+netbox_session.headers.update({
+                            'Content-Type': 'application/json',
+                            'Authorization': NETBOX_TOKEN
+                            })
+
+
+class DeviceSessions:
+    """
+    Keeps one HTTP session per device, so the TLS handshake with the device is done once instead of for every request.
+    At most "size" sessions are kept, the session of the least recently used device is closed.
+    """
+
+    def __init__(self, size, pool_size):
+        self.size = size
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        # device -> session
+        self.sessions = collections.OrderedDict()
+
+    def get(self, host):
+        with self.lock:
+            session = self.sessions.get(host)
+            if session == None:
+                session = create_session(self.pool_size)
+                self.sessions[host] = session
+                while len(self.sessions) > self.size:
+                    self.sessions.popitem(last=False)[1].close()
+            self.sessions.move_to_end(host)
+            return session
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+device_sessions = DeviceSessions(DEVICE_SESSIONS, DEVICE_POOL_SIZE)
+atexit.register(device_sessions.close)
+
+
+# the path of a url in netbox, e.g. "/api/dcim/devices/1/"
+# the webhooks include relative urls and the api absolute ones, so the caches use the path as key
+def netbox_path(url):
+    return urllib.parse.urlsplit(url).path
+
+
+class PrimaryIPCache:
+    """
+    Remembers the primary ip address of the devices, so "get_api_data()" doesnt have to ask Netbox for every webhook.
+    Uses the path of the url to the device in Netbox as key, a device without a primary ip address is cached as "None".
+
+    Entries expire after "ttl" seconds and the least recently used entry is removed when "size" is exceeded.
+    The entries are also updated by the device and ipaddress webhooks, see "update_ip_cache()".
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # url -> (primary ip, time of expiry)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # returns a tuple of "True" and the primary ip when cached, otherwise "False" and "None"
+    def get(self, url):
+        url = netbox_path(url)
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry != None and entry[1] > time.monotonic():
+                self.entries.move_to_end(url)
+                self.hits += 1
+                return True, entry[0]
+            if entry != None:
+                # expired
+                del self.entries[url]
+            self.misses += 1
+            return False, None
+
+    def set(self, url, ip):
+        url = netbox_path(url)
+        with self.lock:
+            self.entries[url] = (ip, time.monotonic() + self.ttl)
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, url):
+        with self.lock:
+            self.entries.pop(netbox_path(url), None)
+
+    # removes every device which has "address" cached as its primary ip
+    def invalidate_address(self, address):
+        with self.lock:
+            for url in [url for url, entry in self.entries.items() if entry[0] == address]:
+                del self.entries[url]
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+ip_cache = PrimaryIPCache(IP_CACHE_SIZE, IP_CACHE_TTL)
+
+
+# an estimate of the memory used by a structure of dicts, lists, tuples and strings, in bytes
+def deep_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key) + deep_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(deep_size(item) for item in value)
+    return size
+
+
+class NetboxIndex:
+    """
+    Keeps the primary ip address of every device, loaded from Netbox in bulk.
+    After a restart "get_api_data()" finds the addresses here instead of asking Netbox once per webhook.
+
+    The index is loaded one page at a time from the list endpoints of the Netbox API in the background when the script starts,
+    the time it took and the memory it uses are printed. Every "refresh" seconds the devices and ip addresses
+    changed since the last time are fetched with the "last_updated" filter, a device whose primary ip changed
+    is removed from "ip_cache" so the next webhook finds the new one here. Deleted objects and changes that
+    happen in between are handled by the webhooks, see "update_ip_cache()".
+    The devices are keyed by the path of their url in Netbox, e.g. "/api/dcim/devices/1/".
+    """
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        # device path -> (id of the primary ip, primary ip)
+        self.devices = {}
+        # id of a primary ip -> device path
+        self.addresses = {}
+        self.thread = None
+        self.ready = threading.Event()
+        self.hits = 0
+        self.misses = 0
+
+    # loads the index in the background, called when the script starts
+    def start(self):
+        with self.lock:
+            if self.thread != None or not NETBOX_INDEX:
+                return
+            self.thread = threading.Thread(target=self.loop, name='omniconf-netbox-index', daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        since = None
+        while True:
+            started = time.time()
+            try:
+                self.load(since)
+                if since == None:
+                    with self.lock:
+                        print(f'netbox index: {len(self.devices)} devices loaded in {time.time() - started:.1f} s, using {self.memory() / 1024:.0f} KiB')
+                    self.ready.set()
+                # a minute of overlap, in case the clocks of netbox and the script differ
+                since = started - 60
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.refresh)
+
+    # fetches the objects changed since "since", or all of them
+    def load(self, since):
+        params = {}
+        if since != None:
+            params['last_updated__gte'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(since))
+        for device in netbox_pages('/api/dcim/devices/', params):
+            if self.set_device(device['url'], device.get('primary_ip')):
+                ip_cache.invalidate(device['url'])
+        if since != None:
+            # an address can change without the device it is the primary ip of changing
+            for address in netbox_pages('/api/ipam/ip-addresses/', params):
+                with self.lock:
+                    device = self.addresses.get(address['id'])
+                    changed = device != None and self.devices[device][1] != address['address']
+                    if changed:
+                        self.devices[device] = (address['id'], address['address'])
+                if changed:
+                    ip_cache.invalidate(device)
+
+    # returns "True" when the primary ip of the device wasnt in the index like this before
+    def set_device(self, url, primary_ip):
+        key = netbox_path(url)
+        with self.lock:
+            previous = self.devices.get(key)
+            if previous != None and previous[0] != None:
+                self.addresses.pop(previous[0], None)
+            if primary_ip != None:
+                self.devices[key] = (primary_ip['id'], primary_ip['address'])
+                self.addresses[primary_ip['id']] = key
+            else:
+                self.devices[key] = (None, None)
+            return previous != self.devices[key]
+
+    def remove_device(self, url):
+        key = netbox_path(url)
+        with self.lock:
+            previous = self.devices.pop(key, None)
+            if previous != None and previous[0] != None:
+                self.addresses.pop(previous[0], None)
+
+    # removes every device which has "address" as its primary ip, they are fetched again when needed
+    def invalidate_address(self, address):
+        with self.lock:
+            for key in [key for key, (ip_id, ip) in self.devices.items() if ip == address]:
+                ip_id = self.devices.pop(key)[0]
+                self.addresses.pop(ip_id, None)
+
+    # returns a tuple of "True" and the primary ip when the device is in the index, otherwise "False" and "None"
+    def get(self, url):
+        with self.lock:
+            entry = self.devices.get(netbox_path(url))
+            if entry == None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, entry[1]
+
+    # called with the lock held
+    def memory(self):
+        return deep_size(self.devices) + deep_size(self.addresses)
+
+    def stats(self):
+        with self.lock:
+            return {'devices': len(self.devices), 'bytes': self.memory(), 'hits': self.hits, 'misses': self.misses}
+
+
+netbox_index = NetboxIndex(NETBOX_INDEX_REFRESH)
+
+
+# keeps "ip_cache" and "netbox_index" up to date with the primary ip addresses included in the webhooks
+def update_ip_cache(webhook):
+    model = webhook.get('model')
+    event = webhook.get('event')
+    data = webhook.get('data') or {}
+
+    # the device webhook includes the primary ip address of the device
+    # it is also sent when the primary ip of the device is changed from the ipaddress form
+    if model == 'device' and 'url' in data:
+        if event == 'deleted':
+            ip_cache.invalidate(data['url'])
+            netbox_index.remove_device(data['url'])
+        elif data.get('primary_ip') != None:
+            ip_cache.set(data['url'], data['primary_ip']['address'])
+            netbox_index.set_device(data['url'], data['primary_ip'])
+        else:
+            ip_cache.set(data['url'], None)
+            netbox_index.set_device(data['url'], None)
+
+    # an address that changes or gets deleted might be the primary ip of a device
+    elif model == 'ipaddress' and event in ('updated', 'deleted'):
+        prechange = webhook.get('snapshots', {}).get('prechange') or {}
+        if 'address' in prechange:
+            ip_cache.invalidate_address(prechange['address'])
+            netbox_index.invalidate_address(prechange['address'])
+
+
 # performs a HTTP GET request to netbox api for the devices' primary ip address
 def get_api_data(config):
+    # the primary ip address is often already known
+    cached, ip = ip_cache.get(config['information'])
+    if cached:
+        return ip
+    # or it was loaded from netbox in bulk
+    indexed, ip = netbox_index.get(config['information'])
+    if indexed:
+        ip_cache.set(config['information'], ip)
+        return ip
+
     # consist of the ip address to netbox and the url to the device
     url = NETBOX_IP + config['information']
-    # HTTP header
-    headers =   {
-                'Content-Type': 'application/json', 
-                'Authorization': NETBOX_TOKEN 
-                }
-    # performs the GET request
-    api_data = requests.request('GET', url, headers=headers, verify=False)
+    # performs the GET request, the HTTP header is part of "netbox_session"
+    api_data = netbox_session.get(url, timeout=HTTP_TIMEOUT)
     # response data as json
     api_data = api_data.json()
 
@@ -175,9 +666,10 @@ def get_api_data(config):
     # otherwise returns "None"
     if api_data['primary_ip'] != None:
         ip = api_data['primary_ip']['address']
-        return ip
     else:
-        return None
+        ip = None
+    ip_cache.set(config['information'], ip)
+    return ip
     
 
 # this function separates prefix and address from each other
@@ -203,7 +695,8 @@ def split_address(address, mask=False):
 
 # this class is taken from the Ansible python API example: "https://docs.ansible.com/ansible/latest/dev_guide/developing_api.html"
 # create a callback plugin so we can capture the output
-class ResultsCollectorJSONCallback(CallbackBase):
+# the plugin is "ResultsCollectorJSONCallback", created by "import_ansible()" from this class and CallbackBase
+class ResultsCollector:
     """A sample callback plugin used for performing an action as results come in.
 
     If you want to collect all results into a single object for processing at
@@ -212,7 +705,7 @@ class ResultsCollectorJSONCallback(CallbackBase):
     """
 
     def __init__(self, *args, **kwargs):
-        super(ResultsCollectorJSONCallback, self).__init__(*args, **kwargs)
+        super(ResultsCollector, self).__init__(*args, **kwargs)
         self.host_ok = {}
         self.host_unreachable = {}
         self.host_failed = {}
@@ -228,96 +721,60 @@ class ResultsCollectorJSONCallback(CallbackBase):
         """
         host = result._host
         self.host_ok[host.get_name()] = result
-        print(json.dumps({host.name: result._result}, indent=4))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps({host.name: result._result}, indent=4))
 
     def v2_runner_on_failed(self, result, *args, **kwargs):
         host = result._host
         self.host_failed[host.get_name()] = result
 
-# this code is also taken from "https://docs.ansible.com/ansible/latest/dev_guide/developing_api.html"
-# but it has been heavily edited
-# this function creates and runs an Ansible play
-def run_playbook(config, ip, event, model, data, prechange):
-    """
-    Part 1:
-    Apart from "host" this part consist of the orignal code,
-    although some parameters have been changed as well.
-    Initializes and loads necessary data for Ansible to operate.
 
-    Part 2:
-    Creates the data structure that represents our play, including tasks, this is basically what our YAML loader does internally.
-    The Ansible restconf_config module is used for each play (task), which yang data model used might differ between the plays.
+if not LAZY_IMPORTS:
+    import_ansible()
+
+# creates the Ansible tasks that configure the device according to the job
+def build_tasks(config, event, model, data, prechange):
+    """
+    Creates the data structure that represents the tasks of our play, this is basically what our YAML loader does internally.
+    The Ansible restconf_config module is used for each task, which yang data model used might differ between the tasks.
     The task and payload is defined using prior extrapolated data where the task that will be performed by the device is decided by the event,
     i.e. a "deleted" event will result in a "delete" task being executed. Appropriate parameters for the event are also specified in the task,
     such as "path" or "method". The payload consists of the appropriate yang-data-model used and the configuration dict.
 
-    Part 3: 
-    Compiles and executes the Ansible playbook and reports back the result.
-
-    Part 4:
-    Saves the configuration on the device to startup-config.
-    This doesnt seem to be doable with the ansible restconf plugin using the cisco-ia module, 
-    so we use requests to send a HTTP post msg instead of executing it as a playbook.
+    Returns the tasks as a list, which is empty when the event doesnt result in any configuration.
     """
 
-    # part 1
-    # removes mask from the ip
-    host = split_address(ip)
-
-    # since the API is constructed for CLI it expects certain options to always be set in the context object
-    context.CLIARGS = ImmutableDict(connection='smart', forks=10, verbosity=True, check=False, diff=False)
-
-    # initialize needed objects
-    loader = DataLoader() # takes care of finding and reading yaml, json and ini files
-    passwords = dict(vault_pass=ANSIBLE_VAULTPASS)
-
-    # instantiate our ResultsCollectorJSONCallback for handling results as they come in. Ansible expects this to be one of its main display outlets
-    results_callback = ResultsCollectorJSONCallback()
-
-    # create inventory, use path to host config file as source or hosts in a comma separated string
-    inventory = InventoryManager(loader=loader, sources=ANSIBLE_INVFILE)
+    # stays empty for events without configuration, e.g. a device being created
+    task = []
 
-    # variable manager takes care of merging all the different sources to give you a unified view of variables available in each context
-    variable_manager = VariableManager(loader=loader, inventory=inventory)
-
-    # instantiate task queue manager, which takes care of forking and setting up all objects to iterate over host list and tasks
-    # IMPORTANT: This also adds library dirs paths to the module loader
-    # IMPORTANT: and so it must be initialized before calling `Play.load()`.
-    tqm = TaskQueueManager(
-        inventory=inventory,
-        variable_manager=variable_manager,
-        loader=loader,
-        passwords=passwords,
-        stdout_callback=results_callback,  # use our custom callback instead of the ``default`` callback plugin, which prints to stdout
-    )
-
-    # part 2
     # interface configuration
     # uses the ietf-yang-data-model interfaces-module
     if model == 'interface':
         # name of the target interface 
         # used in the path when altering an existing interface
         name = data['name']
+        # a copy, so the job keeps the netbox values and its tasks can be created again
+        configuration = dict(config['configuration'])
         # first checks if 'type' exist in conf, then converts the interface type
         # from a netbox value to a value supported by the ietf-interface module 
-        if 'type' in config['configuration']:
+        if 'type' in configuration:
             # "virtual" gets converted to "softwareLoopback"
-            if config['configuration']['type'] == 'virtual':
-                config['configuration']['type'] = 'softwareLoopback'
+            if configuration['type'] == 'virtual':
+                configuration['type'] = 'softwareLoopback'
             # other types gets converted to "ethernetCsmacd"
             else:
-                config['configuration']['type'] = 'ethernetCsmacd'
+                configuration['type'] = 'ethernetCsmacd'
 
         # when interface is created in netbox
         if event == 'created':
             # "configuration" dict as payload
-            payload = {"ietf-interfaces:interface":config['configuration']}
+            payload = {"ietf-interfaces:interface":configuration}
             # this task will create the interface on the device
             task = [dict(action=dict(module='ansible.netcommon.restconf_config', args=dict(path='/data/ietf-interfaces:interfaces', content=json.dumps(payload), method='post')))]
 
         # when interface is edited in netbox
         elif event == 'updated':
-            payload = {"ietf-interfaces:interface:":config['configuration']}
+            payload = {"ietf-interfaces:interface:":configuration}
             # updates the interface on the device
             task = [dict(action=dict(module='ansible.netcommon.restconf_config', args=dict(path=f'/data/ietf-interfaces:interfaces/interface={name}', content=json.dumps(payload), method='patch')))]
 
@@ -396,89 +853,1696 @@ def run_playbook(config, ip, event, model, data, prechange):
             task = [dict(action=dict(module='ansible.netcommon.restconf_config', args=dict(path='/data/Cisco-IOS-XE-native:native/hostname',
                         content=json.dumps(payload), method='patch')))]
 
-    # part 3
-    # generates and runs the playbook with the task given above
-    play_source = dict(
-    name='Ansible Play',
-    hosts=[host],
-    gather_facts='no',
-    tasks=task
-    )
+    return task
 
-    # Create play object, playbook objects use .load instead of init or new methods,
-    # this will also automatically create the task objects from the info provided in play_source
-    play = Play().load(play_source, variable_manager=variable_manager, loader=loader)
 
-    # Actually run it
-    try:
-        result = tqm.run(play)  # most interesting data for a play is actually sent to the callback's methods
-    finally:
+class AnsibleRuntime:
+    """
+    Keeps the Ansible objects needed to run a play alive between the plays,
+    instead of parsing the inventory and var files again for every webhook.
+
+    The inventory file and the var files in the "group_vars" and "host_vars" directories next to it
+    are checked for changes at most every "ANSIBLE_RELOAD_INTERVAL" seconds.
+    A changed inventory is parsed again and changed var files are read again the next time they are needed.
+    A reload waits for the running plays to finish, plays started during a reload wait for it to finish.
+
+    Every worker thread gets its own TaskQueueManager and callback, since a TaskQueueManager can only run one play at a time.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.condition = threading.Condition()
+        # number of plays using the objects
+        self.users = 0
+        self.reloading = False
+        # increased after every reload, used to detect stale data
+        self.generation = 0
+        self.checked = 0
+        self.signature = None
+        self.loader = None
+        # the TaskQueueManager of each worker thread
+        self.local = threading.local()
+        self.managers = []
+        # set once a play has loaded the Ansible plugins
+        self.warm = False
+        self.warmup_lock = threading.Lock()
+
+    # the files that affect the inventory and its variables
+    def watched_files(self):
+        files = [self.sources]
+        directory = os.path.dirname(os.path.abspath(self.sources))
+        for vars_dir in ('group_vars', 'host_vars'):
+            for root, dirs, names in os.walk(os.path.join(directory, vars_dir)):
+                for name in names:
+                    files.append(os.path.join(root, name))
+        return files
+
+    # the modification time and size of every watched file
+    def scan(self):
+        signature = {}
+        for path in self.watched_files():
+            try:
+                stat = os.stat(path)
+                signature[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                signature[path] = None
+        return signature
+
+    # part 1 of the original "run_playbook()", executed once
+    def load(self):
+        import_ansible()
+        # since the API is constructed for CLI it expects certain options to always be set in the context object
+        # "become" is needed by the httpapi connection when a play has more than one task
+        # the forks are only used by the plays for several devices, see "run_fanout()"
+        context.CLIARGS = ImmutableDict(connection='smart', forks=ANSIBLE_FORKS or 4 * (os.cpu_count() or 1), become=False, verbosity=True, check=False, diff=False)
+        # makes the collections, e.g. ansible.netcommon, available
+        if init_plugin_loader != None:
+            init_plugin_loader([])
+
+        # initialize needed objects
+        self.loader = DataLoader() # takes care of finding and reading yaml, json and ini files
+        self.passwords = dict(vault_pass=ANSIBLE_VAULTPASS)
+
+        # create inventory, use path to host config file as source or hosts in a comma separated string
+        self.inventory = InventoryManager(loader=self.loader, sources=self.sources)
+
+        # variable manager takes care of merging all the different sources to give you a unified view of variables available in each context
+        self.variable_manager = VariableManager(loader=self.loader, inventory=self.inventory)
+
+        # the variables of each host, as seen by a play
+        self.hostvars = HostVars(inventory=self.inventory, variable_manager=self.variable_manager, loader=self.loader)
+
+        self.signature = self.scan()
+        self.checked = time.monotonic()
+
+    # reloads what has changed since the last check
+    def reload(self, signature):
+        inventory_changed = signature.get(self.sources) != self.signature.get(self.sources)
+        vars_changed = {path: stat for path, stat in signature.items() if path != self.sources} != \
+                       {path: stat for path, stat in self.signature.items() if path != self.sources}
+
+        if vars_changed:
+            # the var files are cached by the loader and the vars plugin, both are read again when needed
+            self.loader._FILE_CACHE.clear()
+            try:
+                from ansible.plugins.vars import host_group_vars
+                host_group_vars.FOUND.clear()
+            except (ImportError, AttributeError):
+                pass
+        if inventory_changed:
+            self.inventory.refresh_inventory()
+
+        print('Ansible inventory reloaded' if inventory_changed else 'Ansible var files reloaded')
+        self.signature = signature
+        self.generation += 1
+
+    @contextlib.contextmanager
+    def use(self):
+        with self.condition:
+            if self.loader == None:
+                self.load()
+
+            # waits for a reload started by another thread
+            while self.reloading:
+                self.condition.wait()
+
+            if time.monotonic() - self.checked >= ANSIBLE_RELOAD_INTERVAL:
+                self.checked = time.monotonic()
+                signature = self.scan()
+                if signature != self.signature:
+                    self.reloading = True
+                    try:
+                        # the objects must not change while a play is using them
+                        while self.users:
+                            self.condition.wait()
+                        self.reload(signature)
+                    finally:
+                        self.reloading = False
+                        self.condition.notify_all()
+
+            self.users += 1
+        try:
+            yield self
+        finally:
+            with self.condition:
+                self.users -= 1
+                self.condition.notify_all()
+
+    # Ansible loads its plugins the first time they are used, which isnt thread safe,
+    # so the plays are run one at a time until a play has loaded them
+    @contextlib.contextmanager
+    def warmup(self):
+        if self.warm:
+            yield
+            return
+        with self.warmup_lock:
+            yield
+            self.warm = True
+
+    # returns the TaskQueueManager and callback of the calling worker thread, ready for a new play
+    def task_queue_manager(self):
+        tqm = getattr(self.local, 'tqm', None)
+        if tqm == None:
+            # instantiate our ResultsCollectorJSONCallback for handling results as they come in. Ansible expects this to be one of its main display outlets
+            results_callback = ResultsCollectorJSONCallback()
+
+            # instantiate task queue manager, which takes care of forking and setting up all objects to iterate over host list and tasks
+            # IMPORTANT: This also adds library dirs paths to the module loader
+            # IMPORTANT: and so it must be initialized before calling `Play.load()`.
+            tqm = TaskQueueManager(
+                inventory=self.inventory,
+                variable_manager=self.variable_manager,
+                loader=self.loader,
+                passwords=self.passwords,
+                stdout_callback=results_callback,  # use our custom callback instead of the ``default`` callback plugin, which prints to stdout
+            )
+            self.local.tqm = tqm
+            self.local.callback = results_callback
+            with self.condition:
+                self.managers.append(tqm)
+
+        # results of the previous play are forgotten, otherwise failed hosts would be skipped by the next play
+        results_callback = self.local.callback
+        results_callback.host_ok = {}
+        results_callback.host_failed = {}
+        results_callback.host_unreachable = {}
+        tqm.clear_failed_hosts()
+        tqm._unreachable_hosts.clear()
+        return tqm, results_callback
+
+    # throws away the TaskQueueManager of the calling thread, used after a play crashed
+    def discard_task_queue_manager(self):
+        tqm = getattr(self.local, 'tqm', None)
+        if tqm != None:
+            self.local.tqm = None
+            with self.condition:
+                self.managers.remove(tqm)
+            tqm.cleanup()
+
+    # called when the process ends
+    def cleanup(self):
         # we always need to cleanup child procs and the structures we use to communicate with them
-        tqm.cleanup()
-        if loader:
-            loader.cleanup_all_tmp_files()
+        for tqm in self.managers:
+            tqm.cleanup()
+        if self.loader:
+            self.loader.cleanup_all_tmp_files()
 
-    # Remove ansible tmpdir
-    shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
+        # Remove ansible tmpdir, unless Ansible was never imported
+        if C != None:
+            shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
 
-    # Prints the outcome of playbook that executed
+
+ansible_runtime = AnsibleRuntime(ANSIBLE_INVFILE)
+atexit.register(ansible_runtime.cleanup)
+
+
+class CredentialCache:
+    """
+    Keeps the connection details and credentials of the devices, so the variables of a device are merged
+    and its vault encrypted var files are decrypted once instead of for every change and save-config.
+
+    An entry belongs to the generation of "ansible_runtime" it was read in and is read again
+    once the inventory or var files have changed. The least recently used entry is removed when "size" is exceeded.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        # device -> (generation, connection)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # returns the connection when cached for the generation, otherwise "None"
+    def get(self, host, generation):
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry != None and entry[0] == generation:
+                self.entries.move_to_end(host)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def set(self, host, generation, connection):
+        with self.lock:
+            self.entries[host] = (generation, connection)
+            self.entries.move_to_end(host)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+credential_cache = CredentialCache(CREDENTIAL_CACHE_SIZE)
+
+
+# returns the url to the restconf api of the device and the basic auth for it
+# the connection details and credentials are loaded from the Ansible inventory and var files, or "credential_cache"
+def device_connection(host):
+    with ansible_runtime.use():
+        generation = ansible_runtime.generation
+        connection = credential_cache.get(host, generation)
+        if connection != None:
+            return connection
+        # loaded_vars contains all the host variables that ansible loads from the varfiles
+        loaded_vars = ansible_runtime.hostvars[host]
+        # restconf username loaded from ansible
+        username = loaded_vars['ansible_user']
+        # restconf password loaded from ansible
+        password = loaded_vars['ansible_httpapi_password']
+        address = loaded_vars.get('ansible_host', host)
+        port = loaded_vars.get('ansible_httpapi_port')
+        use_ssl = loaded_vars.get('ansible_httpapi_use_ssl', True)
+        root = loaded_vars.get('ansible_httpapi_restconf_root', '/restconf')
+
+    scheme = 'https' if str(use_ssl).lower() in ('yes', 'true', 'on', '1') else 'http'
+    base_url = f'{scheme}://{address}:{port}{root}' if port else f'{scheme}://{address}{root}'
+    # creates a HTTP basic auth field with the restconf user/password
+    connection = (base_url, HTTPBasicAuth(username, password))
+    credential_cache.set(host, generation, connection)
+    return connection
+
+
+# prints the outcome of the tasks that were executed
+# "results" contains the result of each host when it was successful, failed or unreachable
+def report_results(results):
     print('SUCCESSFUL ***********')
-    for host, result in results_callback.host_ok.items():
+    for host, result in results['ok'].items():
+        # when the tasks were sent as a YANG-Patch
+        if 'edits' in result:
+            for edit in result['edits']:
+                print('{0} >>> {1} {2} {3}'.format(host, edit['operation'], edit['target'], edit['status']))
         # when a playbook performs delete
-        if not 'candidate' in result._result:
-            print('{0} >>> {1} \n{2}'.format(host, result._result['changed'], result._result['invocation']))
+        elif not 'candidate' in result:
+            print('{0} >>> {1} \n{2}'.format(host, result['changed'], result['invocation']))
         # when a playbook performs create/update
         else:
-            print('{0} >>> {1}'.format(host, result._result['candidate']))
+            print('{0} >>> {1}'.format(host, result['candidate']))
 
     print('FAILED *******')
     # failed to execute the play
-    for host, result in results_callback.host_failed.items():
-        print('{0} >>> {1}'.format(host, result._result['msg']))
+    for host, result in results['failed'].items():
+        print('{0} >>> {1}'.format(host, result['msg']))
+        for edit in result.get('edits', []):
+            print('{0} >>> {1} {2} {3} {4}'.format(host, edit['operation'], edit['target'], edit['status'], edit['errors'] or ''))
 
     print('UNREACHABLE *********')
     # couldnt reach the host
-    for host, result in results_callback.host_unreachable.items():
-        print('{0} >>> {1}'.format(host, result._result['msg']))
+    for host, result in results['unreachable'].items():
+        print('{0} >>> {1}'.format(host, result['msg']))
 
-    # part 4
-    # saves the configuration on the device
-    # loaded_vars contains all the host variables that ansible loads from the varfiles
-    loaded_vars = variable_manager._hostvars
-    # restconf username loaded from ansible
-    username = loaded_vars[host]['ansible_user']
-    # restconf password loaded from ansible
-    password = loaded_vars[host]['ansible_httpapi_password']
-
-    # uses cisco-ai module to invoke an RPC that saves the running conf to startup 
-    path = 'https://' + host + '/restconf/operations/cisco-ia:save-config'
+
+# saves the configuration on the device
+# this doesnt seem to be doable with the ansible restconf plugin using the cisco-ia module,
+# so we use requests to send a HTTP post msg instead of executing it as a playbook
+def save_config(host):
+    base_url, dev_auth = device_connection(host)
+    # uses cisco-ai module to invoke an RPC that saves the running conf to startup
+    path = base_url + '/operations/cisco-ia:save-config'
     header =  {'Content-type': 'application/yang-data+json'}
-    # creates a HTTP basic auth field with the restconf user/password
-    dev_auth = HTTPBasicAuth(username, password)
 
-    # sends the HTTP post
-    saveconf = requests.post(path, headers=header, verify=False, auth=dev_auth)
+    # sends the HTTP post over the open connection to the device
+    with stage_seconds.time('save_config', '', '', host):
+        saveconf = device_sessions.get(host).post(path, headers=header, auth=dev_auth, timeout=HTTP_TIMEOUT)
+    # a save the device refused is a failed save, not one with an error message as response
+    saveconf.raise_for_status()
     # saves the response msg
     saveconf = saveconf.json()
-    # prints the response msg
-    print(json.dumps(saveconf, indent=4))
+    # logs the response msg
+    logger.debug(json.dumps(saveconf, indent=4))
+    return saveconf
 
 
-# the parameters which flask listens to for webhooks
-@app.route(FLASK_PATH, methods=['POST'])
-def respond():
+# checks if the device answers restconf requests, used before sending it changes again after it was unreachable
+def probe_device(host):
+    base_url, dev_auth = device_connection(host)
+    try:
+        response = device_sessions.get(host).get(base_url, headers={'Accept': 'application/yang-data+json'}, auth=dev_auth, timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        return False
+    # any answer but a server error means the device is back
+    return response.status_code < 500
+
+
+# this code is also taken from "https://docs.ansible.com/ansible/latest/dev_guide/developing_api.html"
+# but it has been heavily edited
+# this function creates and runs an Ansible play
+def run_playbook(host, tasks):
     """
-    This functions runs when receiving a webhook.
-    Below is the flask app code that receives the webhook.
-    Calls the functions responsible for each step.
-    If a function returns a value of None, the webhook wont be processed futher.
-    In the code this is represented as a "return Response(=200)", which is a 
-    HTTP response to the HTTP webhook POST. 
-    Functions and terms are further explained in conjunction with the functions
-    
-    First of all the received webhook is stored in a variable and
-    some of its' important parts are stored in other variables.
-    These variables are used in different functions to extract data.
+    Part 1:
+    The Ansible objects are created once and reused by every play, see "AnsibleRuntime".
+    Each worker thread uses its own TaskQueueManager.
+
+    Part 2:
+    The tasks created by "build_tasks()" are executed in the given order as a single play,
+    a burst of changes to the same device therefore results in only one play.
+
+    Part 3:
+    Compiles and executes the Ansible playbook and reports back the result.
+
+    Part 4:
+    Requests a save of the configuration on the device to startup-config, see "save_config()" and "SaveDebouncer".
+    Returns the results of the play.
+    """
+
+    # part 1
+    started = time.perf_counter()
+    with ansible_runtime.use():
+        loader = ansible_runtime.loader
+        variable_manager = ansible_runtime.variable_manager
+        tqm, results_callback = ansible_runtime.task_queue_manager()
+
+        # part 2
+        # all of the tasks are executed in the order they were received
+        task = tasks
+
+        # part 3
+        # generates and runs the playbook with the task given above
+        play_source = dict(
+        name='Ansible Play',
+        hosts=[host],
+        gather_facts='no',
+        tasks=task
+        )
+
+        # Create play object, playbook objects use .load instead of init or new methods,
+        # this will also automatically create the task objects from the info provided in play_source
+        play = Play().load(play_source, variable_manager=variable_manager, loader=loader)
+        stage_seconds.observe(time.perf_counter() - started, 'ansible_setup', '', '', host)
+
+        # Actually run it
+        try:
+            with ansible_runtime.warmup(), stage_seconds.time('tqm_run', '', '', host):
+                result = tqm.run(play)  # most interesting data for a play is actually sent to the callback's methods
+        except Exception:
+            # the child procs might be left in an unknown state, the next play gets a new TaskQueueManager
+            ansible_runtime.discard_task_queue_manager()
+            raise
+
+    results = {
+              'ok': {name: result._result for name, result in results_callback.host_ok.items()},
+              'failed': {name: result._result for name, result in results_callback.host_failed.items()},
+              'unreachable': {name: result._result for name, result in results_callback.host_unreachable.items()}
+              }
+    report_results(results)
+
+    # part 4
+    # saves the configuration on the device, unless it couldnt be reached
+    # the save is postponed as long as more changes are coming in
+    if host not in results['unreachable']:
+        save_debouncer.request(host)
+
+    return results
+
+
+def run_fanout(batches):
+    """
+    Executes the tasks for several devices as one Ansible play, used by the coalescer when the windows of several devices
+    close at the same time, e.g. for a bulk change across a site. "batches" contains the tasks per device.
+    The play configures up to "ANSIBLE_FORKS" devices at the same time, instead of a play per device.
+
+    The tasks of every device are passed to the play in the "omniconf_tasks" variable, the n-th task of the play
+    executes the n-th task of each device that has one. A device whose task fails doesnt execute its remaining tasks,
+    the same as in a play for one device.
+    Returns the results per device, in the same form as "run_playbook()".
+    """
+
+    started = time.perf_counter()
+    with ansible_runtime.use():
+        tqm, results_callback = ansible_runtime.task_queue_manager()
+
+        task = []
+        for i in range(max(len(tasks) for tasks in batches.values())):
+            item = f'omniconf_tasks[inventory_hostname][{i}]'
+            # "string" keeps the content a json string, older Ansible versions would turn it into a dict
+            args = dict(path='{{ ' + item + '.path }}', method='{{ ' + item + '.method }}',
+                        content='{{ ' + item + '.content | string if "content" in ' + item + ' else omit }}')
+            task.append(dict(action=dict(module='ansible.netcommon.restconf_config', args=args),
+                             when=f'omniconf_tasks[inventory_hostname] | length > {i}'))
+
+        play_source = dict(
+        name='Ansible Play',
+        hosts=list(batches),
+        gather_facts='no',
+        vars=dict(omniconf_tasks={host: [t['action']['args'] for t in tasks] for host, tasks in batches.items()}),
+        tasks=task
+        )
+        play = Play().load(play_source, variable_manager=ansible_runtime.variable_manager, loader=ansible_runtime.loader)
+        stage_seconds.observe(time.perf_counter() - started, 'ansible_setup', '', '', '')
+
+        try:
+            with ansible_runtime.warmup(), stage_seconds.time('tqm_run', '', '', ''):
+                tqm.run(play)
+        except Exception:
+            ansible_runtime.discard_task_queue_manager()
+            raise
+
+    collected = {'ok': results_callback.host_ok, 'failed': results_callback.host_failed, 'unreachable': results_callback.host_unreachable}
+    report_results({status: {name: result._result for name, result in hosts.items()} for status, hosts in collected.items()})
+
+    # the results are split up per device
+    results = {host: {'ok': {}, 'failed': {}, 'unreachable': {}} for host in batches}
+    for status, hosts in collected.items():
+        for name, result in hosts.items():
+            results[name][status][name] = result._result
+
+    # the configuration is saved on every device that could be reached
+    for host in batches:
+        if host not in results[host]['unreachable']:
+            save_debouncer.request(host)
+
+    return results
+
+
+def run_restconf(host, tasks):
+    """
+    Executes the tasks created by "build_tasks()" without Ansible, used when "EXECUTOR" is 'restconf'.
+    The path, method and content of each task is sent as a HTTP request over the open connection to the device,
+    the same way the restconf_config module does it. The connection details and credentials are taken from the Ansible inventory and var files.
+
+    Like a play, the remaining tasks are not executed when a task fails.
+    The result is reported in the same way as for a play and the configuration is saved afterwards.
+    """
+
+    base_url, dev_auth = device_connection(host)
+    session = device_sessions.get(host)
+    header = {'Content-type': 'application/yang-data+json', 'Accept': 'application/yang-data+json'}
+    results = {'ok': {}, 'failed': {}, 'unreachable': {}}
+
+    for task in tasks:
+        args = task['action']['args']
+        try:
+            with stage_seconds.time('restconf', '', '', host):
+                response = session.request(args['method'].upper(), base_url + args['path'], data=args.get('content'),
+                                           headers=header, auth=dev_auth, timeout=HTTP_TIMEOUT)
+        except requests.RequestException as error:
+            # couldnt reach the host
+            results['unreachable'][host] = {'msg': str(error)}
+            break
+
+        if not response.ok:
+            results['failed'][host] = {'msg': f'{response.status_code} {response.reason}: {response.text}'}
+            break
+
+        # same keys as the restconf_config module returns
+        if 'content' in args:
+            results['ok'][host] = {'changed': True, 'candidate': json.loads(args['content'])}
+        else:
+            results['ok'][host] = {'changed': True, 'invocation': {'module_args': args}}
+
+    report_results(results)
+
+    if host not in results['unreachable']:
+        save_debouncer.request(host)
+
+    return results
+
+
+# turns a task created by "build_tasks()" into an edit of a YANG-Patch (RFC 8072)
+def yang_patch_edit(edit_id, args):
+    # the target is relative to the datastore, the path of the task starts with "/data"
+    target = args['path'][len('/data'):]
+    method = args['method'].lower()
+
+    if method == 'delete':
+        return {'edit-id': edit_id, 'operation': 'delete', 'target': target}
+
+    content = json.loads(args['content'])
+    name, value = next(iter(content.items()))
+    if method == 'post':
+        # a post creates an entry in the list at the path, the entry becomes the target
+        target = f'{target}/{name.split(":")[-1]}={urllib.parse.quote(str(value["name"]), safe="")}'
+        operation = 'create'
+    else:
+        operation = 'merge'
+        interface = '/ietf-interfaces:interfaces/interface='
+        if target.startswith(interface):
+            # the entry of a list needs its key, the payload of an interface update is keyed "ietf-interfaces:interface:",
+            # one bad edit makes the device reject the whole patch
+            key = target[len(interface):]
+            name = 'ietf-interfaces:interface'
+            value = {'name': key, **value}
+            target = interface + urllib.parse.quote(key, safe='')
+    # the value of a list entry is a list with the entry
+    if target.rsplit('/', 1)[-1].find('=') != -1 and isinstance(value, dict):
+        value = [value]
+    return {'edit-id': edit_id, 'operation': operation, 'target': target, 'value': {name: value}}
+
+
+# devices that refused a YANG-Patch, their tasks are sent as separate requests
+yang_patch_unsupported = set()
+
+
+def run_yang_patch(host, tasks):
+    """
+    Executes the tasks created by "build_tasks()" as a single YANG-Patch request, used when "EXECUTOR" is 'yang-patch'.
+    Every task becomes an edit of the patch, which is sent as one PATCH of the datastore.
+    The device applies all edits or none of them, e.g. an ip address is replaced without the interface being without address in between.
+
+    The device reports the status of each edit, which is added to the result.
+    Devices that dont support YANG-Patch are remembered and get their tasks from "run_restconf()" instead.
+    """
+
+    if host in yang_patch_unsupported:
+        return run_restconf(host, tasks)
+
+    base_url, dev_auth = device_connection(host)
+    header = {'Content-type': 'application/yang-patch+json', 'Accept': 'application/yang-data+json'}
+    results = {'ok': {}, 'failed': {}, 'unreachable': {}}
+
+    edits = [yang_patch_edit(str(i), task['action']['args']) for i, task in enumerate(tasks, 1)]
+    patch = {'ietf-yang-patch:yang-patch': {'patch-id': f'omniconf-{time.time_ns()}', 'edit': edits}}
+
+    try:
+        with stage_seconds.time('yang_patch', '', '', host):
+            response = device_sessions.get(host).patch(base_url + '/data', data=json.dumps(patch), headers=header,
+                                                       auth=dev_auth, timeout=HTTP_TIMEOUT)
+    except requests.RequestException as error:
+        # couldnt reach the host
+        results['unreachable'][host] = {'msg': str(error)}
+        report_results(results)
+        return results
+
+    if response.status_code in (405, 415, 501):
+        print(host, 'doesnt support YANG-Patch, sending the tasks as separate requests')
+        yang_patch_unsupported.add(host)
+        return run_restconf(host, tasks)
+
+    # the device answers with the status of the whole patch and of each edit that failed
+    try:
+        status = response.json().get('ietf-yang-patch:yang-patch-status', {})
+    except ValueError:
+        status = {}
+    failed = {edit['edit-id']: edit.get('errors') for edit in status.get('edit-status', {}).get('edit', []) if 'ok' not in edit}
+    edit_status = [{'edit-id': edit['edit-id'], 'operation': edit['operation'], 'target': edit['target'],
+                    'status': 'failed' if edit['edit-id'] in failed else ('ok' if response.ok else 'not applied'),
+                    'errors': failed.get(edit['edit-id'])} for edit in edits]
+
+    if response.ok and failed == {}:
+        results['ok'][host] = {'changed': True, 'edits': edit_status}
+    else:
+        results['failed'][host] = {'msg': f'{response.status_code} {response.reason}: {response.text}', 'edits': edit_status}
+
+    report_results(results)
+
+    # a failed patch didnt change anything on the device
+    if host in results['ok']:
+        save_debouncer.request(host)
+
+    return results
+
+
+class SaveDebouncer:
+    """
+    Postpones the save of the configuration until no changes have been made to the device during "quiet" seconds,
+    so a burst of changes results in a single save-config. A save is never postponed more than "max_delay" seconds.
+    The saves are executed by the worker pool and the pending saves are executed when the process ends.
+    """
+
+    def __init__(self, quiet, max_delay, save):
+        self.quiet = quiet
+        self.max_delay = max_delay
+        # function that saves the configuration of a device
+        self.save = save
+        self.condition = threading.Condition()
+        # device -> (time of first request, time the save is due)
+        self.pending = {}
+        self.thread = None
+        # number of saves that were requested, executed and left out because another save covered them
+        self.requested = 0
+        self.saved = 0
+        self.elided = 0
+
+    # called after the configuration of the device was changed
+    def request(self, host):
+        now = time.monotonic()
+        with self.condition:
+            self.requested += 1
+            if host in self.pending:
+                first = self.pending[host][0]
+                self.elided += 1
+            else:
+                first = now
+            self.pending[host] = (first, min(now + self.quiet, first + self.max_delay))
+
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.loop, name='omniconf-save-debouncer', daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    # hands the saves over to the worker pool when they are due
+    def loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    due = [host for host, (first, deadline) in self.pending.items() if deadline <= now]
+                    if due:
+                        for host in due:
+                            del self.pending[host]
+                        break
+                    if self.pending:
+                        self.condition.wait(min(deadline for first, deadline in self.pending.values()) - now)
+                    else:
+                        self.condition.wait()
+
+            for host in due:
+                submit(self.run, host)
+
+    # "wait" waits for room on the device instead of deferring the save, see "DeviceLimiter"
+    def run(self, host, wait=False):
+        # while the device is down the save waits for it to be back
+        if breaker.park(host, self.run, host):
+            return
+        if wait:
+            device_limiter.wait(host)
+        elif device_limiter.defer(host, self.run_admitted, host):
+            return
+        self.run_admitted(host)
+
+    def run_admitted(self, host):
+        started = time.monotonic()
+        try:
+            self.save(host)
+        except requests.RequestException as error:
+            device_limiter.release(host, 'save', time.monotonic() - started, 1, False)
+            breaker.record(host, {'ok': {}, 'failed': {}, 'unreachable': {host: {'msg': str(error)}}})
+            if breaker.park(host, self.run, host):
+                return
+            raise
+        except Exception:
+            device_limiter.release(host, 'save', time.monotonic() - started, 1, False)
+            raise
+        device_limiter.release(host, 'save', time.monotonic() - started, 1, True)
+        with self.condition:
+            self.saved += 1
+        print('configuration saved on', host, '- saves:', self.stats())
+
+    # saves the pending configurations right away, used when the process ends
+    # the saves are executed by "pool" when given, otherwise one at a time
+    def flush(self, pool=None):
+        with self.condition:
+            hosts = list(self.pending)
+            self.pending.clear()
+        if pool != None:
+            futures = [pool.submit(self.run, host, True) for host in hosts]
+            for future in futures:
+                if future.exception() != None:
+                    traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+            return
+        for host in hosts:
+            try:
+                self.run(host, True)
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        with self.condition:
+            return {'requested': self.requested, 'saved': self.saved, 'elided': self.elided, 'pending': len(self.pending)}
+
+
+save_debouncer = SaveDebouncer(SAVE_QUIET_WINDOW, SAVE_MAX_DELAY, save_config)
+atexit.register(save_debouncer.flush)
+
+# atexit isnt run when the process is terminated by a signal, so SIGTERM is turned into a normal exit
+# unless the WSGI server already handles it
+if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+# returns what a task does to the device as a tuple of the kind of change, the interface name and the values,
+# the kind is "None" for a task that isnt recognized
+def describe_task(task):
+    args = task['action']['args']
+    path = args['path']
+    method = args['method']
+    content = json.loads(args['content']) if 'content' in args else {}
+
+    if path == '/data/Cisco-IOS-XE-native:native/hostname':
+        return 'hostname', None, content.get('Cisco-IOS-XE-native:hostname')
+
+    if path == '/data/ietf-interfaces:interfaces' and method == 'post':
+        values = content['ietf-interfaces:interface']
+        return 'interface', values['name'], values
+
+    if path == '/data/ietf-interfaces:interfaces' and method == 'patch':
+        # an interface merged into the interfaces, see "merge_interface_task()"
+        values = content['ietf-interfaces:interfaces']['interface'][0]
+        return 'interface', values['name'], values
+
+    if path.startswith('/data/ietf-interfaces:interfaces/interface='):
+        name = path[len('/data/ietf-interfaces:interfaces/interface='):]
+        if '/ietf-ip:' in name:
+            # path to an address of the interface
+            name, address = name.split('/ietf-ip:')
+            family, ip = address.split('/address=')
+            return 'address-delete', name, (family, ip)
+        if method == 'delete':
+            return 'interface-delete', name, None
+        # the payload key is "ietf-interfaces:interface" or "ietf-interfaces:interface:"
+        values = [value for key, value in content.items() if key.startswith('ietf-interfaces:interface')][0]
+        for key in values:
+            if key.startswith('ietf-ip:'):
+                family = key[len('ietf-ip:'):]
+                return 'address', name, (family, values[key]['address'][0])
+        return 'interface', name, values
+
+    return None, None, None
+
+
+class DeviceStateCache:
+    """
+    Remembers the configuration of the devices read with RESTCONF, used to leave out the tasks
+    that wouldnt change anything on the device. Only used when "DIFF_BEFORE_PUSH" is enabled.
+
+    The hostname and the interfaces including their addresses are read from the device and trusted for "ttl" seconds.
+    After the tasks have been executed the remembered configuration is updated with the changes,
+    or thrown away when something went wrong.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # device -> (configuration, time of expiry)
+        self.states = {}
+        self.fetches = 0
+        # tasks and saves that were left out because the device already had the configuration
+        self.skipped_writes = 0
+        self.skipped_saves = 0
+
+    # reads the hostname and interfaces from the device
+    def fetch(self, host):
+        base_url, dev_auth = device_connection(host)
+        session = device_sessions.get(host)
+        header = {'Accept': 'application/yang-data+json'}
+
+        interfaces = session.get(base_url + '/data/ietf-interfaces:interfaces', headers=header, auth=dev_auth, timeout=HTTP_TIMEOUT)
+        interfaces.raise_for_status()
+        hostname = session.get(base_url + '/data/Cisco-IOS-XE-native:native/hostname', headers=header, auth=dev_auth, timeout=HTTP_TIMEOUT)
+        hostname.raise_for_status()
+
+        state = {'hostname': hostname.json().get('Cisco-IOS-XE-native:hostname'), 'interfaces': {}}
+        for interface in interfaces.json().get('ietf-interfaces:interfaces', {}).get('interface', []):
+            entry = {
+                    'name': interface['name'],
+                    # "iana-if-type:softwareLoopback" is compared as "softwareLoopback"
+                    'type': interface.get('type', '').split(':')[-1],
+                    'enabled': interface.get('enabled', True),
+                    'description': interface.get('description', '')
+                    }
+            for family in ('ipv4', 'ipv6'):
+                entry[family] = {address['ip']: address for address in interface.get(f'ietf-ip:{family}', {}).get('address', [])}
+            state['interfaces'][interface['name']] = entry
+
+        with self.lock:
+            self.fetches += 1
+        return state
+
+    # returns the remembered configuration, reads it from the device when needed
+    def get(self, host):
+        with self.lock:
+            entry = self.states.get(host)
+            if entry != None and entry[1] > time.monotonic():
+                return entry[0]
+        state = self.fetch(host)
+        with self.lock:
+            self.states[host] = (state, time.monotonic() + self.ttl)
+        return state
+
+    def invalidate(self, host):
+        with self.lock:
+            self.states.pop(host, None)
+
+    # returns "True" when the task wouldnt change anything on the device with configuration "state"
+    def is_applied(self, state, task):
+        kind, name, values = describe_task(task)
+        interface = state['interfaces'].get(name)
+
+        if kind == 'hostname':
+            return state['hostname'] == values
+        if kind == 'interface':
+            return interface != None and all(interface.get(key) == value for key, value in values.items())
+        if kind == 'interface-delete':
+            return interface == None
+        if kind == 'address':
+            family, address = values
+            return interface != None and interface[family].get(address['ip']) == address
+        if kind == 'address-delete':
+            family, ip = values
+            return interface == None or ip not in interface[family]
+        return False
+
+    # changes "state" as the task would change the device
+    def apply(self, state, task):
+        kind, name, values = describe_task(task)
+        interfaces = state['interfaces']
+
+        if kind == 'hostname':
+            state['hostname'] = values
+        elif kind == 'interface':
+            interface = interfaces.setdefault(name, {'name': name, 'type': '', 'enabled': True, 'description': '', 'ipv4': {}, 'ipv6': {}})
+            interface.update(values)
+        elif kind == 'interface-delete':
+            interfaces.pop(name, None)
+        elif kind == 'address' and name in interfaces:
+            family, address = values
+            interfaces[name][family][address['ip']] = address
+        elif kind == 'address-delete' and name in interfaces:
+            family, ip = values
+            interfaces[name][family].pop(ip, None)
+        elif kind == None:
+            # unknown change, the configuration is read again next time
+            return False
+        return True
+
+    # returns the tasks that would change the device, in the same order
+    def changed_tasks(self, host, tasks):
+        try:
+            state = copy.deepcopy(self.get(host))
+        except Exception as error:
+            # the tasks are sent as usual when the configuration of the device cant be read
+            print('could not read the configuration of', host, '-', repr(error))
+            return tasks
+
+        changed = []
+        for task in tasks:
+            if self.is_applied(state, task):
+                continue
+            changed.append(task)
+            # later tasks are compared to the configuration after this task
+            self.apply(state, task)
+
+        with self.lock:
+            self.skipped_writes += len(tasks) - len(changed)
+            if changed == []:
+                self.skipped_saves += 1
+        return changed
+
+    # updates the remembered configuration after the tasks were executed
+    def update(self, host, tasks, results):
+        with self.lock:
+            entry = self.states.get(host)
+            if entry == None:
+                return
+            if host in results['failed'] or host in results['unreachable']:
+                del self.states[host]
+                return
+
+            state = copy.deepcopy(entry[0])
+            for task in tasks:
+                if not self.apply(state, task):
+                    del self.states[host]
+                    return
+            self.states[host] = (state, entry[1])
+
+    def stats(self):
+        with self.lock:
+            return {'devices': len(self.states), 'fetches': self.fetches, 'skipped_writes': self.skipped_writes, 'skipped_saves': self.skipped_saves}
+
+
+device_states = DeviceStateCache(DEVICE_STATE_TTL)
+
+
+executors = {'ansible': run_playbook, 'restconf': run_restconf, 'yang-patch': run_yang_patch}
+
+
+# runs the tasks for the device with the executor selected by "EXECUTOR"
+def execute(host, tasks):
+    if DIFF_BEFORE_PUSH:
+        # leaves out the tasks which the device already has the configuration for
+        changed = device_states.changed_tasks(host, tasks)
+        if changed == []:
+            print('nothing to change on', host, '- diff:', device_states.stats())
+            return {'ok': {}, 'failed': {}, 'unreachable': {}}
+        results = executors[EXECUTOR](host, changed)
+        device_states.update(host, changed, results)
+        return results
+
+    return executors[EXECUTOR](host, tasks)
+
+
+# executes the tasks for several devices as one play, see "run_fanout()", returns the results per device
+def execute_many(batches):
+    results = {}
+    if DIFF_BEFORE_PUSH:
+        changed = {}
+        for host, tasks in batches.items():
+            changed[host] = device_states.changed_tasks(host, tasks)
+            if changed[host] == []:
+                print('nothing to change on', host, '- diff:', device_states.stats())
+                results[host] = {'ok': {}, 'failed': {}, 'unreachable': {}}
+                del changed[host]
+        batches = changed
+    if batches != {}:
+        results.update(run_fanout(batches))
+    if DIFF_BEFORE_PUSH:
+        for host, tasks in batches.items():
+            device_states.update(host, tasks, results[host])
+    return results
+
+
+# whether the coalescer may execute the tasks for several devices as one play,
+# the shards get the tasks per device and only Ansible runs plays
+def can_fan_out():
+    return EXECUTOR == 'ansible' and FANOUT_SIZE > 1 and shard_ring.nodes() == []
+
+
+class HashRing:
+    """
+    Consistent hashing of the devices onto the shards, every shard is placed on the ring at "SHARD_VNODES" points
+    and a device belongs to the first shard after the hash of its primary IP.
+    When a shard joins or leaves only the devices between its points and the previous points move.
+    """
+
+    def __init__(self, nodes=(), vnodes=SHARD_VNODES):
+        self.vnodes = vnodes
+        self.lock = threading.Lock()
+        # sorted hashes of the points and the shard at each point
+        self.points = []
+        self.owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    # returns "False" when the shard was already on the ring
+    def add(self, node):
+        with self.lock:
+            if node in self.owners.values():
+                return False
+            for i in range(self.vnodes):
+                point = self.hash(f'{node}#{i}')
+                bisect.insort(self.points, point)
+                self.owners[point] = node
+            return True
+
+    def remove(self, node):
+        with self.lock:
+            for point in [point for point, owner in self.owners.items() if owner == node]:
+                del self.owners[point]
+                self.points.remove(point)
+
+    # the shard the device belongs to, "None" when there are no shards
+    def get(self, key):
+        with self.lock:
+            if self.points == []:
+                return None
+            index = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+            return self.owners[self.points[index]]
+
+    def nodes(self):
+        with self.lock:
+            return sorted(set(self.owners.values()))
+
+
+shard_ring = HashRing(SHARDS)
+# the session used for the shards, the connections are kept open like the ones to the devices
+shard_session = create_session(WORKER_COUNT * 2, hosts=64)
+
+
+# the header the shards and the router send each other
+def shard_headers():
+    return {'Authorization': f'Token {SHARD_TOKEN}'} if SHARD_TOKEN else {}
+
+
+# runs the tasks for the device on the shard it belongs to, or in this process when there are no shards
+def dispatch(host, tasks):
+    """
+    Used by the coalescer, which only sends the next tasks for a device once the previous ones are done,
+    so the order per device is kept even when the device moves to another shard.
+
+    A shard that cant be reached or doesnt answer in time is taken off the ring and the tasks go to the next shard.
+    A shard that timed out might still execute them, so a device can get the same tasks twice but never out of order
+    with the tasks after them.
+    """
+
+    while True:
+        shard = shard_ring.get(host)
+        if shard == None:
+            return execute(host, tasks)
+        try:
+            response = shard_session.post(shard + SHARD_PATH + '/execute', data=json.dumps({'host': host, 'tasks': tasks}),
+                                          headers=dict(shard_headers(), **{'Content-type': 'application/json'}),
+                                          timeout=(HTTP_TIMEOUT[0], SHARD_TIMEOUT))
+        except requests.RequestException as error:
+            print('shard', shard, 'left:', error)
+            shard_ring.remove(shard)
+            continue
+        if not response.ok:
+            return {'ok': {}, 'failed': {host: {'msg': f'shard {shard}: {response.status_code} {response.reason}: {response.text}'}}, 'unreachable': {}}
+        return response.json()
+
+
+# jobs waiting to be executed by the worker pool
+# every item is a function together with the arguments it should be called with
+job_queue = queue.Queue()
+
+
+# hands a function call over to the worker pool
+def submit(function, *args):
+    job_queue.put((function, args))
+
+
+# the worker pool drains "job_queue", so slow devices never hold up the webhook connection
+def worker():
+    while True:
+        function, args = job_queue.get()
+        try:
+            function(*args)
+        except Exception:
+            # a failing job must not take the worker down with it
+            traceback.print_exc()
+        finally:
+            job_queue.task_done()
+
+
+# functions called with the jobs and the results once the tasks of the jobs have been executed
+# the results are "None" when the job didnt result in any tasks,
+# when the tasks couldnt be executed the job is failed in them, see "failed_results()"
+job_listeners = []
+
+
+def finish_jobs(jobs, results):
+    for listener in job_listeners:
+        try:
+            listener(jobs, results)
+        except Exception:
+            traceback.print_exc()
+
+
+# the results for tasks that couldnt be executed because of "error", in the same form as the results of a play
+def failed_results(host, error):
+    return {'ok': {}, 'failed': {host: {'msg': repr(error)}}, 'unreachable': {}}
+
+
+class CircuitBreaker:
+    """
+    Stops sending changes to a device that is down, instead of every job waiting for the connection to time out.
+
+    The breaker of a device opens when it is unreachable, or when "threshold" plays in a row failed.
+    While it is open the work for the device is parked: it doesnt use a worker and is called again, in the order it was parked,
+    once the breaker closes. After "backoff" seconds the device is probed, when it answers the breaker closes,
+    otherwise the backoff is doubled up to "max_backoff" seconds.
+    """
+
+    def __init__(self, threshold, backoff, max_backoff, probe):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # function that returns "True" when the device answers
+        self.probe = probe
+        self.condition = threading.Condition()
+        # device -> number of failed plays in a row
+        self.failures = {}
+        # device -> {'backoff': seconds, 'retry': time of the next probe, 'parked': [(function, args)], 'probing': bool}
+        self.open = {}
+        self.thread = None
+        self.opened = 0
+
+    # called with the results of the tasks for the device
+    def record(self, host, results):
+        with self.condition:
+            if host in results['unreachable']:
+                self.trip(host)
+            elif host in results['failed']:
+                self.failures[host] = self.failures.get(host, 0) + 1
+                if self.failures[host] >= self.threshold:
+                    self.trip(host)
+            else:
+                self.failures.pop(host, None)
+
+    # opens the breaker, called with the lock held
+    def trip(self, host):
+        self.failures.pop(host, None)
+        if host in self.open:
+            return
+        print('device', host, 'is down, its changes are parked until it is back')
+        self.opened += 1
+        self.open[host] = {'backoff': self.backoff, 'retry': time.monotonic() + self.backoff, 'parked': [], 'probing': False}
+        if self.thread == None:
+            self.thread = threading.Thread(target=self.loop, name='omniconf-circuit-breaker', daemon=True)
+            self.thread.start()
+        self.condition.notify()
+
+    # parks the function call when the breaker of the device is open and returns "True", otherwise returns "False"
+    def park(self, host, function, *args):
+        with self.condition:
+            if host not in self.open:
+                return False
+            self.open[host]['parked'].append((function, args))
+            return True
+
+    # hands the probes over to the worker pool when they are due
+    def loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    due = [host for host, state in self.open.items() if not state['probing'] and state['retry'] <= now]
+                    if due:
+                        for host in due:
+                            self.open[host]['probing'] = True
+                        break
+                    waiting = [state['retry'] for state in self.open.values() if not state['probing']]
+                    self.condition.wait(min(waiting) - now if waiting else None)
+
+            for host in due:
+                submit(self.check, host)
+
+    def check(self, host):
+        try:
+            back = self.probe(host)
+        except Exception:
+            traceback.print_exc()
+            back = False
+        with self.condition:
+            state = self.open[host]
+            if not back:
+                state['backoff'] = min(state['backoff'] * 2, self.max_backoff)
+                state['retry'] = time.monotonic() + state['backoff']
+                state['probing'] = False
+                self.condition.notify()
+                return
+            del self.open[host]
+        print('device', host, 'is back, replaying', len(state['parked']), 'parked changes')
+        # the calls are run one after another, like they would have been
+        for function, args in state['parked']:
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        with self.condition:
+            return {'open': len(self.open), 'parked': sum(len(state['parked']) for state in self.open.values()), 'opened': self.opened}
+
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_BACKOFF, BREAKER_MAX_BACKOFF, probe_device)
+
+
+class DeviceLimiter:
+    """
+    Keeps the plays and saves from overloading a device, the Restconf API of a device falls over quickly under parallel writes.
+    Every device gets a token bucket of "rate" plays and saves per second and at most "concurrency" of them run at the same time.
+    At most "total" run at the same time across all devices.
+
+    The limits of a device adapt to how it responds, AIMD-style: a play or save that succeeds raises the rate by one
+    and the concurrency by a fraction, one that fails, or takes "slow_factor" times longer per task than usual for the device, halves them.
+    Work that has to wait is deferred without using a worker and called in order per device once the device has room,
+    the devices with waiting work take turns, so a device at its limits doesnt hold up the work for the others.
+    """
+
+    def __init__(self, rate, max_rate, concurrency, max_concurrency, slow_factor, total):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.slow_factor = slow_factor
+        self.total = total
+        self.condition = threading.Condition()
+        # device -> {'rate', 'concurrency', 'tokens', 'updated', 'running', 'usual': {kind: seconds per task}, 'waiting': deque of (function, args)}
+        self.devices = {}
+        # devices with waiting work, in the order they get their turn
+        self.queued = collections.OrderedDict()
+        self.running = 0
+        self.thread = None
+        self.deferred = 0
+        self.lowered = 0
+
+    def device(self, host):
+        state = self.devices.get(host)
+        if state == None:
+            state = {'rate': self.rate, 'concurrency': self.concurrency, 'tokens': 1.0, 'updated': time.monotonic(),
+                     'running': 0, 'usual': {}, 'waiting': collections.deque()}
+            self.devices[host] = state
+        return state
+
+    # takes a token and a slot when the device has room, called with the lock held
+    def take(self, state, now):
+        if self.total and self.running >= self.total:
+            return False
+        if state['running'] >= int(state['concurrency']):
+            return False
+        if self.rate:
+            state['tokens'] = min(max(1.0, state['rate']), state['tokens'] + (now - state['updated']) * state['rate'])
+            state['updated'] = now
+            if state['tokens'] < 1:
+                return False
+            state['tokens'] -= 1
+        state['running'] += 1
+        self.running += 1
+        return True
+
+    # returns "False" when the device has room right away, the caller then goes ahead and calls "release()" when done
+    # otherwise the function call is deferred and returns "True", the function is called with the room taken
+    def defer(self, host, function, *args):
+        with self.condition:
+            state = self.device(host)
+            if not state['waiting'] and self.take(state, time.monotonic()):
+                return False
+            state['waiting'].append((function, args))
+            self.queued[host] = None
+            self.deferred += 1
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.loop, name='omniconf-device-limiter', daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+            return True
+
+    # waits until the device has room, for callers that arent part of the worker pool
+    # blocks the calling thread itself, so it works without the worker pool too, e.g. for the saves flushed at exit
+    def wait(self, host):
+        with self.condition:
+            state = self.device(host)
+            while True:
+                now = time.monotonic()
+                # deferred work for the device goes first
+                if not state['waiting'] and self.take(state, now):
+                    return
+                refill = None
+                if state['running'] < int(state['concurrency']) and state['tokens'] < 1:
+                    refill = (1 - state['tokens']) / state['rate']
+                self.condition.wait(refill)
+
+    # called when the play or save is done, "tasks" is the number of tasks it executed
+    def release(self, host, kind, seconds, tasks, ok):
+        with self.condition:
+            state = self.devices[host]
+            state['running'] -= 1
+            self.running -= 1
+            if tasks:
+                per_task = seconds / tasks
+                usual = state['usual'].get(kind)
+                if not ok or (usual != None and per_task > usual * self.slow_factor):
+                    # multiplicative decrease
+                    state['rate'] = max(0.1, state['rate'] / 2)
+                    state['concurrency'] = max(1.0, state['concurrency'] / 2)
+                    self.lowered += 1
+                    print('device', host, 'is overloaded, limits lowered to', round(state['rate'], 1), 'per second and', int(state['concurrency']), 'at the same time')
+                else:
+                    # additive increase
+                    state['rate'] = min(self.max_rate, state['rate'] + 1)
+                    state['concurrency'] = min(self.max_concurrency, state['concurrency'] + 1 / state['concurrency'])
+                if ok:
+                    state['usual'][kind] = per_task if usual == None else usual * 0.8 + per_task * 0.2
+            self.condition.notify_all()
+
+    # hands the deferred work over to the worker pool when the devices have room
+    def loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    due = []
+                    refill = None
+                    for host in list(self.queued):
+                        state = self.devices[host]
+                        if not self.take(state, now):
+                            if state['running'] < int(state['concurrency']) and state['tokens'] < 1:
+                                refill = min(refill or 60, (1 - state['tokens']) / state['rate'])
+                            continue
+                        due.append(state['waiting'].popleft())
+                        # the device gets its next turn after the others
+                        del self.queued[host]
+                        if state['waiting']:
+                            self.queued[host] = None
+                    if due:
+                        break
+                    self.condition.wait(refill)
+
+            for function, args in due:
+                submit(function, *args)
+
+    def stats(self):
+        with self.condition:
+            return {'running': self.running, 'waiting': sum(len(state['waiting']) for state in self.devices.values()),
+                    'deferred': self.deferred, 'lowered': self.lowered}
+
+
+device_limiter = DeviceLimiter(DEVICE_RATE, DEVICE_MAX_RATE, DEVICE_CONCURRENCY, DEVICE_MAX_CONCURRENCY, DEVICE_SLOW_FACTOR, TOTAL_CONCURRENCY)
+
+
+# whether the results show that the tasks were executed without errors
+def succeeded(host, results):
+    return results != None and host not in results['failed'] and host not in results['unreachable']
+
+
+# the deleted job of an object which was updated first, the update never reaches the device,
+# so the object is deleted as it was before the update: an ip address by the address the device has, an interface by its name
+def deleted_as_before(updated, deleted):
+    prechange = updated['prechange'] or {}
+    data = dict(deleted['data'])
+    configuration = dict(deleted['config']['configuration'])
+    if deleted['model'] == 'interface' and prechange.get('name'):
+        data['name'] = prechange['name']
+    if deleted['model'] == 'ipaddress' and prechange.get('address'):
+        configuration['address'] = prechange['address']
+    return dict(deleted, config=dict(deleted['config'], configuration=configuration), data=data)
+
+
+# folds the jobs for the same object into their net effect, used by the coalescer when "COMPACT_EVENTS" is set
+def compact_jobs(entries):
+    """
+    Takes the jobs gathered for a device as a list of (job, tasks) in the order they were received,
+    and returns the tasks to execute together with the number of jobs that were folded away.
+
+    The jobs are keyed by model and netbox id:
+    * created followed by updated becomes one created with the final values
+    * updated followed by updated becomes one updated with the changed values merged,
+      the prechange of the first update is kept, so an ip address is replaced by removing the address the device has
+    * created followed by deleted cancels out, both are dropped
+    * updated followed by deleted becomes the deleted, which is executed in the place of the deleted,
+      it deletes the object as the device has it, from the prechange of the first update, see "deleted_as_before()"
+    Folded creates and updates are executed in the place of the first job, so the object exists before it is used.
+    The tasks of folded jobs are created again by "build_tasks()". Any other sequence is executed as it is.
+    """
+
+    # list of [job, tasks], "None" for a slot that was folded away
+    slots = []
+    # model and id -> index of the slot with the last job for the object
+    objects = {}
+    folded = 0
+
+    for job, tasks in entries:
+        if job == None or job['data'].get('id') == None:
+            slots.append([job, tasks])
+            continue
+        key = (job['model'], job['data']['id'])
+        index = objects.get(key)
+        if index == None:
+            objects[key] = len(slots)
+            slots.append([job, tasks])
+            continue
+
+        previous = slots[index][0]
+        sequence = (previous['event'], job['event'])
+        if sequence == ('created', 'updated') and job['model'] == 'device':
+            # a device gets no configuration when created, the update is executed on its own
+            slots[index] = [job, tasks]
+        elif sequence in (('created', 'updated'), ('updated', 'updated')):
+            configuration = dict(previous['config']['configuration'], **job['config']['configuration'])
+            job = dict(previous, config={'configuration': configuration, 'information': job['config']['information']}, data=job['data'])
+            slots[index] = [job, None]
+        elif sequence == ('created', 'deleted'):
+            slots[index] = None
+            del objects[key]
+            # the created job is dropped as well
+            folded += 1
+        elif sequence == ('updated', 'deleted'):
+            job = deleted_as_before(previous, job)
+            slots[index] = None
+            objects[key] = len(slots)
+            slots.append([job, None])
+        else:
+            objects[key] = len(slots)
+            slots.append([job, tasks])
+            continue
+        folded += 1
+
+    compacted = []
+    for slot in slots:
+        if slot == None:
+            continue
+        job, tasks = slot
+        if tasks == None:
+            tasks = build_tasks(job['config'], job['event'], job['model'], job['data'], job['prechange'])
+        compacted.extend(tasks)
+    return compacted, folded
+
+
+class Coalescer:
+    """
+    Gathers the tasks for the same device during "COALESCE_WINDOW" seconds,
+    the gathered tasks are then executed as one play followed by a single save-config.
+
+    The device primary IP is used as key. Only one play at a time is executed per device,
+    tasks arriving while a play is running are gathered and executed after it, in the order they were received.
+    A batch for a device that is down is parked by the circuit breaker and executed again once the device is back.
+    When "COMPACT_EVENTS" is set, the gathered jobs are folded by "compact_jobs()" first.
+    The jobs the tasks came from are passed to "finish_jobs()" once the play is done.
+
+    When "can_fan_out()" allows it, the devices whose windows close within "FANOUT_WAIT" seconds of each other
+    are executed together by "execute_many", up to "FANOUT_SIZE" devices per play.
+    """
+
+    def __init__(self, window, execute, compact=COMPACT_EVENTS, execute_many=None, fanout_size=FANOUT_SIZE, fanout_wait=FANOUT_WAIT):
+        self.window = window
+        # function called by the worker pool with the device and its tasks
+        self.execute = execute
+        # function called by the worker pool with the tasks per device
+        self.execute_many = execute_many
+        self.fanout_size = fanout_size
+        self.fanout_wait = fanout_wait
+        self.compact = compact
+        self.lock = threading.Lock()
+        # device -> jobs and their tasks waiting for the window to close
+        self.pending = {}
+        # devices with a closed window, waiting for the running play to finish
+        self.due = set()
+        # device -> number of jobs in the running play
+        self.running = {}
+        # jobs folded away by "compact_jobs()"
+        self.folded = 0
+        # devices and their batches waiting to be executed together
+        self.ready = []
+
+    def add(self, host, tasks, job=None):
+        with self.lock:
+            opened = host not in self.pending
+            if opened:
+                self.pending[host] = {'entries': [], 'jobs': []}
+            # when the window is already open, the tasks are added to it
+            self.pending[host]['entries'].append((job, tasks))
+            if job != None:
+                self.pending[host]['jobs'].append(job)
+        if not opened:
+            return
+
+        if self.window > 0:
+            timer = threading.Timer(self.window, self.close, args=(host,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.close(host)
+
+    # called when the window of the device closes
+    def close(self, host):
+        with self.lock:
+            if host in self.running:
+                # dispatched as soon as the running play is done
+                self.due.add(host)
+                return
+            batch = self.pending.pop(host)
+            self.running[host] = len(batch['jobs'])
+        self.start(host, batch)
+
+    # hands the batch over to the worker pool, or to the next play for several devices
+    def start(self, host, batch):
+        if self.execute_many == None or not can_fan_out():
+            submit(self.run, host, batch)
+            return
+        with self.lock:
+            self.ready.append((host, batch))
+            first = len(self.ready) == 1
+        if first:
+            timer = threading.Timer(self.fanout_wait, submit, args=(self.run_many,))
+            timer.daemon = True
+            timer.start()
+
+    # the tasks of the batch, folded when "compact" is set
+    def tasks(self, batch):
+        if not self.compact:
+            return [task for job, job_tasks in batch['entries'] for task in job_tasks]
+        tasks, folded = compact_jobs(batch['entries'])
+        if 'folded' not in batch:
+            batch['folded'] = folded
+            with self.lock:
+                self.folded += folded
+        return tasks
+
+    def run(self, host, batch):
+        # while the device is down the batch waits for it, the tasks received after it wait behind it
+        if breaker.park(host, self.run, host, batch):
+            return
+        # while the device is at its limits the batch waits for room
+        if device_limiter.defer(host, self.run_admitted, host, batch):
+            return
+        self.run_admitted(host, batch)
+
+    # called once the device has room for the batch, see "DeviceLimiter"
+    def run_admitted(self, host, batch):
+        results = None
+        tasks = []
+        started = time.monotonic()
+        try:
+            tasks = self.tasks(batch)
+            if tasks != []:
+                results = self.execute(host, tasks)
+                breaker.record(host, results)
+        except Exception as error:
+            device_limiter.release(host, 'play', time.monotonic() - started, len(tasks), False)
+            self.done(host, batch, failed_results(host, error))
+            raise
+        device_limiter.release(host, 'play', time.monotonic() - started, len(tasks), results == None or succeeded(host, results))
+        self.finish(host, batch, results)
+
+    # executes the waiting batches of several devices together
+    def run_many(self):
+        with self.lock:
+            ready = self.ready[:self.fanout_size]
+            del self.ready[:self.fanout_size]
+            more = self.ready != []
+        # the rest is executed by another worker at the same time
+        if more:
+            submit(self.run_many)
+
+        batches = {}
+        tasks = {}
+        for host, batch in ready:
+            # a parked or deferred batch is executed on its own once the device is back or has room
+            if breaker.park(host, self.run, host, batch):
+                continue
+            if device_limiter.defer(host, self.run_admitted, host, batch):
+                continue
+            try:
+                host_tasks = self.tasks(batch)
+            except Exception as error:
+                traceback.print_exc()
+                device_limiter.release(host, 'play', 0, 0, False)
+                self.done(host, batch, failed_results(host, error))
+                continue
+            if host_tasks == []:
+                device_limiter.release(host, 'play', 0, 0, True)
+                self.done(host, batch, None)
+                continue
+            batches[host] = batch
+            tasks[host] = host_tasks
+        if batches == {}:
+            return
+
+        started = time.monotonic()
+        try:
+            if len(tasks) == 1:
+                results = {host: self.execute(host, host_tasks) for host, host_tasks in tasks.items()}
+            else:
+                results = self.execute_many(tasks)
+        except Exception as error:
+            for host, batch in batches.items():
+                device_limiter.release(host, 'play', time.monotonic() - started, len(tasks[host]), False)
+                self.done(host, batch, failed_results(host, error))
+            raise
+        for host, batch in batches.items():
+            device_limiter.release(host, 'play', time.monotonic() - started, len(tasks[host]), succeeded(host, results[host]))
+            breaker.record(host, results[host])
+            self.finish(host, batch, results[host])
+
+    def finish(self, host, batch, results):
+        # the tasks never reached the device, they are executed again when it is back
+        if results != None and host in results['unreachable'] and breaker.park(host, self.run, host, batch):
+            return
+        self.done(host, batch, results)
+
+    # passes the jobs to "finish_jobs()" and dispatches the next tasks for the device
+    def done(self, host, batch, results):
+        finish_jobs(batch['jobs'], results)
+        with self.lock:
+            if host in self.due:
+                self.due.discard(host)
+                batch = self.pending.pop(host)
+                self.running[host] = len(batch['jobs'])
+            else:
+                del self.running[host]
+                batch = None
+        if batch != None:
+            self.start(host, batch)
+
+    # returns the number of jobs waiting or running per device
+    def in_flight(self):
+        with self.lock:
+            jobs = dict(self.running)
+            for host, batch in self.pending.items():
+                jobs[host] = jobs.get(host, 0) + len(batch['jobs'])
+            return jobs
+
+
+coalescer = Coalescer(COALESCE_WINDOW, dispatch, execute_many=execute_many)
+
+# the worker threads that have been started
+workers = []
+
+
+# starts the worker threads, they run as daemons and end together with the process
+def start_workers(count=WORKER_COUNT):
+    for i in range(count):
+        thread = threading.Thread(target=worker, name=f'omniconf-worker-{len(workers)}', daemon=True)
+        thread.start()
+        workers.append(thread)
+
+
+# the same change delivered again by netbox gets the same fingerprint
+def fingerprint(webhook):
+    data = webhook.get('data')
+    snapshots = json.dumps(webhook.get('snapshots'), sort_keys=True, default=str)
+    key = json.dumps([webhook.get('request_id'), webhook.get('model'), data.get('id') if isinstance(data, dict) else None,
+                      webhook.get('event'), hashlib.md5(snapshots.encode()).hexdigest()])
+    return hashlib.md5(key.encode()).digest()
+
+
+class WebhookDeduplicator:
+    """
+    Drops the webhooks netbox delivers more than once, which it does when the response to a webhook timed out,
+    so a change isnt configured and saved on the device again for every delivery.
+    The webhooks are compared by their fingerprint, see "fingerprint()".
+
+    A fingerprint is remembered for "window" seconds and the oldest are removed when "size" is exceeded.
+    A webhook which was refused is forgotten again, so the next delivery of it isnt dropped.
+    """
+
+    def __init__(self, size, window):
+        self.size = size
+        self.window = window
+        self.lock = threading.Lock()
+        # fingerprint -> time of expiry, in the order they expire
+        self.entries = collections.OrderedDict()
+        self.dropped = 0
+
+    # remembers the fingerprint, returns "False" when it was already seen within the window
+    def add(self, key):
+        if self.window <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            while self.entries and next(iter(self.entries.values())) <= now:
+                self.entries.popitem(last=False)
+            if key in self.entries:
+                self.dropped += 1
+                return False
+            self.entries[key] = now + self.window
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            return True
+
+    def forget(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'dropped': self.dropped}
+
+
+webhook_dedup = WebhookDeduplicator(DEDUP_SIZE, DEDUP_WINDOW)
+
+
+def translate(webhook):
+    """
+    Validates the webhook and translates it into a job, without any network I/O.
+    Returns the job as a dict or "None" when there is nothing to configure.
 
     Step 1 calls the function "check_model" which uses the "model"
     part of the webhook in order to check if the model is configurable.
@@ -495,36 +2559,27 @@ def respond():
     Step 3 configurable values are selected by calling the "pick_out_values()" function with the arguments
     "data", "model" and "values". The function will also return a url to a device in Netbox when "model" is not "device".
     If no configurable values can be selected, the process end.
-
-    Step 4 depending on what model is being configured the retrieval of ip address differ. If the model is "device" the 
-    address is included in the webhook, otherwise the url to the device has to be used and then via Netbox API retrieve the 
-    address from the device. If the device doesnt have a primary ip address assigned to it, the process will end.
-
-    Step 5 is the last step. Calls the "run_playbook()" function in order to create and run an Ansible playbook with data from previous steps.
-    The configuration will be saved on the device. The function only offers full support for Cisco IOS XE devices. For other devices support might vary.
     """
 
-    # the webhook payload is stored in "webhook"
-    webhook = request.json
     # the model which the webhook originated from
     model = webhook['model']
     # the data portion of the webhook
     data = webhook['data']
-    # post- and prechange information    
+    # post- and prechange information
     prechange = webhook['snapshots']['prechange']
     postchange = webhook['snapshots']['postchange']
 
-    print(json.dumps(webhook, indent = 4))
-
     # step 1: check if model is configurable
-    if check_model(model) == True:
+    with stage_seconds.time('check_model', model, webhook.get('event', ''), ''):
+        configurable = check_model(model)
+    if configurable == True:
         event = webhook['event']
 
     # if model is not configurable
     else:
         # ends
         print('model not configurable')
-        return Response(status=200)
+        return None
 
     # step 2: check event
     if event == 'updated':
@@ -532,10 +2587,11 @@ def respond():
             # when prechange contains a value of null
             # this occurs when the "make this the primary IP for the device" option was changed when creating/editing an ipaddress
             # which will send a device webhook as well, with the prechange set to null
-            return Response(status=200)
-        
+            return None
+
         else:
-            values = compare(prechange, postchange)
+            with stage_seconds.time('compare', model, event, ''):
+                values = compare(prechange, postchange)
 
     elif event == 'created':
         values = postchange
@@ -544,13 +2600,18 @@ def respond():
         if prechange == None:
             # when interface is deleted, netbox sends a delete webhook for the ipaddress as well, with empty post- and prechange.
             # in this case the address will be removed along with the interface on the device, which mean no futher action is needed.
-            return Response(status=200)
+            return None
 
         else:
             values = prechange
 
-    #step 3: get configurable values and api url if more info needed  
-    config = pick_out_values(model, data, values)
+    # any other event is not handled
+    else:
+        return None
+
+    #step 3: get configurable values and api url if more info needed
+    with stage_seconds.time('pick_out_values', model, event, ''):
+        config = pick_out_values(model, data, values)
     print('Configurable values: ', config)
 
     if config == None:
@@ -559,21 +2620,666 @@ def respond():
         # 1. the device has no primary IP assigned to it, or
         # 2. a webhook is triggered for an ipaddress which has not been assigned to a device, assigned_objects contains a value of null
         # in this case no configuration has been made, because the change doesnt relate to a device
-        return Response(status=200)
+        return None
+
+    return {'config': config, 'event': event, 'model': model, 'data': data, 'prechange': prechange}
+
+
+def process_job(job):
+    """
+    Runs in the worker pool for every job accepted by "respond()".
+
+    Step 4 depending on what model is being configured the retrieval of ip address differ. If the model is "device" the
+    address is included in the webhook, otherwise the url to the device has to be used and then via Netbox API retrieve the
+    address from the device. If the device doesnt have a primary ip address assigned to it, the process will end.
+
+    Step 5 is the last step. Calls the "build_tasks()" function in order to create the Ansible tasks with data from previous steps.
+    The tasks are handed to the coalescer, which runs all tasks for the same device received during a short window as a single playbook.
+    The configuration will be saved on the device. The function only offers full support for Cisco IOS XE devices. For other devices support might vary.
+    """
+
+    config = job['config']
+    model = job['model']
 
     #step 4: api get request to retrive device primary IP address (included in the webhook for device model)
     if model == 'device':
         ip = config['information']
 
+    elif 'ip' in job:
+        # replayed from the journal, the address was already retrieved before the restart
+        ip = job['ip']
+
     else:
-        ip = get_api_data(config)
-        print('device primary IP is', ip)
+        started = time.perf_counter()
+        try:
+            ip = get_api_data(config)
+        except Exception as error:
+            # the device isnt known yet, the url to it stands in for it
+            finish_jobs([job], failed_results(config['information'], error))
+            raise
+        stage_seconds.observe(time.perf_counter() - started, 'get_api_data', model, job['event'], split_address(ip) if ip != None else '')
+        print('device primary IP is', ip, '- ip cache:', ip_cache.stats())
         if ip == None:
             print()
             print('The targeted device has no primary IP assigned. Nowhere to send conf.')
-            return Response(status=200)
+            finish_jobs([job], None)
+            return
+
+    # the journal remembers the device, so the job is replayed in order with the other jobs for it
+    journal.start(job, ip)
+
+    # removes mask from the ip
+    host = split_address(ip)
+
+    #step 5: create the tasks, the playbook is run by the coalescer
+    try:
+        tasks = build_tasks(config, job['event'], model, job['data'], job['prechange'])
+    except Exception as error:
+        # otherwise the job stays running in the journal and fails again on every replay
+        finish_jobs([job], failed_results(host, error))
+        raise
+    if tasks == []:
+        finish_jobs([job], None)
+        return
+    coalescer.add(host, tasks, job)
+
+
+class Journal:
+    """
+    Writes every accepted webhook to a sqlite database before it is acknowledged,
+    so the jobs that werent finished when the script stopped are executed again when it starts.
+
+    A job is "queued" when accepted, "running" once its device is known and "done" or "failed" when its tasks have been executed.
+    The unfinished jobs are replayed one at a time in the order they were received, so the order per device is kept.
+    Webhooks received during the replay are written to the journal and replayed after them.
+    The finished jobs are removed every "JOURNAL_COMPACT_INTERVAL" seconds.
+    """
+
+    def __init__(self, path, compact_interval):
+        self.path = path
+        self.compact_interval = compact_interval
+        self.lock = threading.Lock()
+        self.connection = None
+        # new jobs are left to the replay until it has caught up with the journal
+        self.recovering = False
+
+    # opens the journal and starts replaying the unfinished jobs
+    def open(self):
+        with self.lock:
+            if self.connection != None or not self.path:
+                return
+            # autocommit, every statement is written to disk when it returns
+            self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            # with the write ahead log a commit only appends to the log, readers and the writer dont block each other
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            # survives the process crashing, only a power loss can undo the last commits
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, webhook TEXT NOT NULL, '
+                                    'status TEXT NOT NULL, ip TEXT, updated REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+            self.recovering = True
+        threading.Thread(target=self.recover, name='omniconf-journal-recovery', daemon=True).start()
+        threading.Thread(target=self.compact_loop, name='omniconf-journal-compaction', daemon=True).start()
+
+    # writes the webhook of the job to the journal, as the body of the request it was received in
+    # returns "True" when the job should be executed by the caller and "False" when the replay executes it
+    def append(self, body, job):
+        if not self.path:
+            return True
+        if isinstance(body, bytes):
+            body = body.decode()
+        self.open()
+        with self.lock:
+            cursor = self.connection.execute('INSERT INTO jobs (webhook, status, updated) VALUES (?, ?, ?)',
+                                             (body, 'queued', time.time()))
+            job['journal'] = cursor.lastrowid
+            return not self.recovering
+
+    # the job is handed to its device
+    def start(self, job, ip):
+        if 'journal' not in job:
+            return
+        with self.lock:
+            self.connection.execute('UPDATE jobs SET status = ?, ip = ?, updated = ? WHERE id = ?',
+                                    ('running', ip, time.time(), job['journal']))
+
+    # called by "finish_jobs()"
+    def finish(self, jobs, results):
+        rows = [job['journal'] for job in jobs if 'journal' in job]
+        if rows == []:
+            return
+        status = 'failed' if results != None and (results['failed'] or results['unreachable']) else 'done'
+        with self.lock:
+            self.connection.executemany('UPDATE jobs SET status = ?, updated = ? WHERE id = ?',
+                                        [(status, time.time(), row) for row in rows])
+
+    # replays the unfinished jobs, including those received during the replay, in the order they were received
+    def recover(self):
+        last = 0
+        replayed = 0
+        while True:
+            with self.lock:
+                rows = self.connection.execute("SELECT id, webhook, ip FROM jobs WHERE status IN ('queued', 'running') AND id > ? ORDER BY id",
+                                               (last,)).fetchall()
+                if rows == []:
+                    self.recovering = False
+                    break
+            for row, webhook, ip in rows:
+                last = row
+                replayed += 1
+                try:
+                    webhook = json_loads(webhook)
+                    update_ip_cache(webhook)
+                    job = translate(webhook)
+                    if job == None:
+                        self.finish([{'journal': row}], None)
+                        continue
+                    job['journal'] = row
+                    job['received'] = time.monotonic()
+                    if ip != None:
+                        job['ip'] = ip
+                    # executed here and not by the worker pool, so the jobs reach the coalescer in order
+                    process_job(job)
+                except Exception:
+                    traceback.print_exc()
+        if replayed:
+            print('journal: replayed', replayed, 'unfinished jobs')
+
+    # removes the finished jobs and shrinks the write ahead log
+    def compact(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM jobs WHERE status IN ('done', 'failed')")
+            self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def compact_loop(self):
+        while True:
+            time.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        if self.connection == None:
+            return {}
+        with self.lock:
+            return dict(self.connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+
+journal = Journal(JOURNAL_PATH, JOURNAL_COMPACT_INTERVAL)
+job_listeners.append(journal.finish)
+
+
+metrics.extend([
+    Gauge('omniconf_queue_depth', 'Number of jobs waiting for a worker.', (), lambda: {(): job_queue.qsize()}),
+    Gauge('omniconf_in_flight_jobs', 'Number of jobs waiting or running per device.', ('device',),
+          lambda: {(host,): jobs for host, jobs in coalescer.in_flight().items()}),
+    Gauge('omniconf_circuit_breaker', 'Devices with an open circuit breaker, the work parked for them and the number of times a breaker opened.', ('value',),
+          lambda: {(key,): value for key, value in breaker.stats().items()}),
+    Gauge('omniconf_webhook_dedup', 'Remembered and dropped webhooks of the deduplication.', ('value',),
+          lambda: {(key,): value for key, value in webhook_dedup.stats().items()}),
+    Gauge('omniconf_device_limiter', 'Plays and saves running and waiting for room on the devices, deferred in total and the number of times the limits of a device were lowered.', ('value',),
+          lambda: {(key,): value for key, value in device_limiter.stats().items()}),
+    Gauge('omniconf_compacted_jobs', 'Number of jobs folded away by compacting the changes to the same object.', (), lambda: {(): coalescer.folded}),
+    Gauge('omniconf_ip_cache', 'Entries, hits and misses of the primary ip cache.', ('value',),
+          lambda: {(key,): value for key, value in ip_cache.stats().items()}),
+    Gauge('omniconf_saves', 'Saves of the configuration requested, executed, elided and pending.', ('value',),
+          lambda: {(key,): value for key, value in save_debouncer.stats().items()}),
+    Gauge('omniconf_credential_cache', 'Entries, hits and misses of the cached device credentials.', ('value',),
+          lambda: {(key,): value for key, value in credential_cache.stats().items()}),
+    Gauge('omniconf_netbox_index', 'Devices, estimated bytes, hits and misses of the index loaded from netbox.', ('value',),
+          lambda: {(key,): value for key, value in netbox_index.stats().items()}),
+    Gauge('omniconf_device_state', 'Devices, reads and skipped writes and saves of the diff before push.', ('value',),
+          lambda: {(key,): value for key, value in device_states.stats().items()}),
+    Gauge('omniconf_journal_jobs', 'Jobs in the journal per status.', ('status',),
+          lambda: {(key,): value for key, value in journal.stats().items()}),
+    ])
+
+
+# the metrics in the prometheus text format
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# serves the metrics for prometheus
+@app.route(METRICS_PATH, methods=['GET'])
+def serve_metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def accept(body):
+    """
+    This functions runs when receiving a webhook, for both the flask app and the asgi app.
+    Only the validation is done while NetBox waits for the response,
+    the configuration of the device is queued and executed by the worker pool.
+    The steps are further explained in "translate()" and "process_job()".
+
+    Takes the body of the request and returns the HTTP status code of the response.
+    A HTTP response of 200 means the webhook was valid but there is nothing to configure, or it was delivered before,
+    202 means a job was queued and 503 means the queue is full, so NetBox should send the webhook again later.
+    400 means the body isnt json.
+    """
+
+    # loads the index when the script was started by a WSGI or ASGI server, does nothing once it is loading
+    netbox_index.start()
+
+    # the webhook payload is stored in "webhook"
+    try:
+        webhook = json_loads(body)
+    except ValueError:
+        return 400
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(webhook, indent = 4))
+
+    # a webhook netbox already delivered is answered without doing anything
+    key = fingerprint(webhook)
+    if not webhook_dedup.add(key):
+        print('duplicate webhook dropped - dedup:', webhook_dedup.stats())
+        return 200
+    try:
+        status = admit(body, webhook)
+    except Exception:
+        # netbox delivers the webhook again, which mustnt be dropped
+        webhook_dedup.forget(key)
+        raise
+    if status == 503:
+        webhook_dedup.forget(key)
+    return status
+
+
+# the part of "accept()" after the deduplication
+def admit(body, webhook):
+    # the webhook might tell us about a new primary ip address
+    update_ip_cache(webhook)
 
-    #step 5: create and run playbook
-    run_playbook(config, ip, event, model, data, prechange)
+    # steps 1-3: validate the webhook and pick out the configuration
+    job = translate(webhook)
+    if job == None:
+        return 200
+    job['received'] = time.monotonic()
 
-    return Response(status=200)
+    # refuses the webhook instead of growing the backlog without bounds
+    if JOB_QUEUE_SIZE and job_queue.qsize() >= JOB_QUEUE_SIZE:
+        print('job queue is full, webhook refused')
+        return 503
+
+    # the body is written to the journal as it was received before the webhook is acknowledged
+    # steps 4-5: executed by the worker pool, or by the journal while it replays the jobs from before a restart
+    if journal.append(body, job):
+        submit(process_job, job)
+
+    return 202
+
+
+# the parameters which flask listens to for webhooks
+# below is the flask app code that receives the webhook, flask needs a thread for every webhook being received
+@app.route(FLASK_PATH, methods=['POST'])
+def respond():
+    return Response(status=accept(request.get_data()))
+
+
+def shard_request(action, body, authorization):
+    """
+    Handles the requests between the router, the process receiving the webhooks, and its shards.
+    Returns the HTTP status code and the response as a dict.
+
+    The router is told by its shards when they join and leave, "body" contains the url of the shard.
+    Every shard gets "WORKER_COUNT" more worker threads on the router, as they mostly wait for the shards.
+    A shard is asked to execute the tasks for a device and answers with the results when done,
+    "body" contains the device and the tasks.
+    """
+
+    # the shards execute whatever tasks they get, so nothing is accepted without the secret
+    if not SHARD_TOKEN or not hmac.compare_digest((authorization or '').encode(), f'Token {SHARD_TOKEN}'.encode()):
+        return 403, {}
+    try:
+        message = json_loads(body)
+    except ValueError:
+        return 400, {}
+
+    if action == 'join':
+        if shard_ring.add(message['url']):
+            print('shard', message['url'], 'joined, shards:', shard_ring.nodes())
+            if len(workers) < WORKER_COUNT * (len(shard_ring.nodes()) + 1):
+                start_workers(WORKER_COUNT)
+        return 200, {'shards': shard_ring.nodes()}
+    if action == 'leave':
+        shard_ring.remove(message['url'])
+        print('shard', message['url'], 'left, shards:', shard_ring.nodes())
+        return 200, {'shards': shard_ring.nodes()}
+    if action == 'execute':
+        return 200, execute(message['host'], message['tasks'])
+    return 404, {}
+
+
+# the shard requests to the flask app, only served once "enable_sharding()" was called
+def respond_shard(action):
+    status, response = shard_request(action, request.get_data(), request.headers.get('Authorization'))
+    # the results of a play can contain values json doesnt know, they are sent as text
+    return Response(json.dumps(response, default=str), status=status, mimetype='application/json')
+
+
+# set once the shard path is served
+sharding = False
+
+
+# serves the shard path on the flask and asgi app, used by the shards and by a router with shards
+# the shard path is on the same port as the webhooks, so it is only served together with a secret
+def enable_sharding():
+    global sharding
+    if sharding:
+        return
+    if not SHARD_TOKEN:
+        raise RuntimeError('SHARD_TOKEN must be set to use shards')
+    app.add_url_rule(SHARD_PATH + '/<action>', 'respond_shard', respond_shard, methods=['POST'])
+    sharding = True
+
+
+# the router serves the shard path when the shards are configured, a token alone lets shards on other servers join it
+if SHARDS or SHARD_TOKEN:
+    enable_sharding()
+
+
+async def asgi_app(scope, receive, send):
+    """
+    The same webhook, shard and metrics paths as the flask app, as an asyncio app for an ASGI server such as uvicorn,
+    e.g. "python main.py serve --asgi" or "uvicorn main:asgi_app".
+
+    A single event loop receives the webhooks, so thousands of open connections dont need a thread each.
+    "accept()" runs in a thread of the event loop's executor, since writing the job to the journal waits for the disk
+    and for the journal lock, the requests to Netbox and the devices are made by the worker pool like with the flask app.
+    """
+
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # replays the unfinished jobs and loads the index right away, instead of when the first webhook is received
+                journal.open()
+                netbox_index.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    headers = []
+    body = b''
+    if scope['method'] == 'POST' and (scope['path'] == FLASK_PATH or (sharding and scope['path'].startswith(SHARD_PATH + '/'))):
+        chunks = []
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            more = message.get('more_body', False)
+        # asyncio is only needed here, it is already imported by the ASGI server
+        import asyncio
+        try:
+            if scope['path'] == FLASK_PATH:
+                # the journal is written with its lock held, which would block the event loop
+                status = await asyncio.get_running_loop().run_in_executor(None, accept, b''.join(chunks))
+            else:
+                authorization = dict(scope['headers']).get(b'authorization', b'').decode()
+                # executing the tasks takes seconds, so it is done by a thread instead of the event loop
+                status, response = await asyncio.get_running_loop().run_in_executor(
+                    None, shard_request, scope['path'][len(SHARD_PATH) + 1:], b''.join(chunks), authorization)
+                headers = [(b'content-type', b'application/json')]
+                body = json.dumps(response, default=str).encode()
+        except Exception:
+            traceback.print_exc()
+            status = 500
+    elif scope['path'] == METRICS_PATH and scope['method'] == 'GET':
+        status = 200
+        headers = [(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')]
+        body = render_metrics().encode()
+    elif scope['path'] in (FLASK_PATH, METRICS_PATH):
+        status = 405
+    else:
+        status = 404
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers + [(b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# returns every object from a list endpoint of the netbox api, one page at a time
+def netbox_pages(path, params):
+    url = NETBOX_IP + path
+    params = dict(params, limit=SYNC_PAGE_SIZE)
+    while url != None:
+        page = netbox_session.get(url, params=params, timeout=HTTP_TIMEOUT)
+        page.raise_for_status()
+        page = page.json()
+        for item in page['results']:
+            yield item
+        # the url to the next page already includes the parameters
+        url = page['next']
+        params = None
+
+
+# the netbox api returns choices as a dict with "value" and "label",
+# the webhook snapshots which "pick_out_values()" expects only contain the value
+def snapshot_values(item):
+    values = {}
+    for key, value in item.items():
+        if isinstance(value, dict) and 'value' in value and 'label' in value:
+            value = value['value']
+        values[key] = value
+    return values
+
+
+# turns the task that creates an interface into one that merges it into the interfaces of the device,
+# which creates the interface when the device doesnt have it yet and updates it otherwise
+def merge_interface_task(task):
+    args = task['action']['args']
+    interface = json.loads(args['content'])['ietf-interfaces:interface']
+    content = {'ietf-interfaces:interfaces': {'interface': [interface]}}
+    return dict(action=dict(module=task['action']['module'], args=dict(args, content=json.dumps(content), method='patch')))
+
+
+def sync_tasks(site=None):
+    """
+    Fetches the devices, interfaces and ip addresses from Netbox and creates the tasks
+    that bring each device in line with Netbox, the same way the webhooks do.
+
+    The device is synced as an updated device, the interfaces are merged into the interfaces of the device,
+    which creates the missing ones and updates the others, and the ip addresses are synced as created ip addresses,
+    so existing configuration is overwritten instead of duplicated.
+    Returns a dict with the primary ip of each device as key and a list of phases as value,
+    the tasks of a phase can be executed in any order but the phases must be executed in order,
+    since the interfaces need to exist before their addresses can be assigned.
+    """
+
+    filters = {'site': site} if site else {}
+
+    # only devices with a primary ip can be configured
+    devices = {}
+    for device in netbox_pages('/api/dcim/devices/', dict(filters, has_primary_ip='true')):
+        devices[device['id']] = device
+        ip_cache.set(device['url'], device['primary_ip']['address'])
+
+    phases = {device_id: ([], []) for device_id in devices}
+
+    for device in devices.values():
+        config = pick_out_values('device', device, snapshot_values(device))
+        if config != None:
+            phases[device['id']][0].extend(build_tasks(config, 'updated', 'device', device, None))
+
+    for interface in netbox_pages('/api/dcim/interfaces/', filters):
+        if interface['device']['id'] in phases:
+            config = pick_out_values('interface', interface, snapshot_values(interface))
+            if config != None:
+                phases[interface['device']['id']][0].extend(merge_interface_task(task) for task in build_tasks(config, 'created', 'interface', interface, None))
+
+    # the ip addresses have no site filter, with a site they are fetched for its devices, a batch of devices at a time
+    if site:
+        device_ids = list(devices)
+        queries = [{'assigned_to_interface': 'true', 'device_id': device_ids[i:i + SYNC_DEVICE_BATCH]}
+                   for i in range(0, len(device_ids), SYNC_DEVICE_BATCH)]
+    else:
+        queries = [{'assigned_to_interface': 'true'}]
+
+    for query in queries:
+        for address in netbox_pages('/api/ipam/ip-addresses/', query):
+            assigned = address['assigned_object']
+            if assigned != None and 'device' in assigned and assigned['device']['id'] in phases:
+                config = pick_out_values('ipaddress', address, snapshot_values(address))
+                if config != None:
+                    phases[assigned['device']['id']][1].extend(build_tasks(config, 'created', 'ipaddress', address, None))
+
+    return {split_address(devices[device_id]['primary_ip']['address']): [phase for phase in device_phases if phase != []]
+            for device_id, device_phases in phases.items()}
+
+
+def sync_netbox(site=None, concurrency=SYNC_CONCURRENCY, device_concurrency=SYNC_DEVICE_CONCURRENCY):
+    """
+    Brings every device in line with Netbox, used to converge after an outage or a missed webhook.
+    Optionally limited to the devices of a site (slug).
+
+    The tasks of each device are split into chunks of "SYNC_CHUNK_SIZE" tasks, each chunk is executed
+    as one play (or one round of requests with the restconf executor).
+    At most "concurrency" chunks are executed at the same time and at most "device_concurrency" for the same device.
+    The configuration of each device is saved once, at the latest when all devices are done, and a summary is printed.
+    Returns the summary as a dict.
+    """
+
+    started = time.monotonic()
+    tasks = sync_tasks(site)
+    fetched = time.monotonic()
+    print(f'fetched {len(tasks)} devices from netbox in {fetched - started:.1f} s')
+
+    # bounds the number of chunks executed at the same time across all devices
+    slots = threading.BoundedSemaphore(concurrency)
+    summary = {'devices': len(tasks), 'tasks': 0, 'ok': 0, 'failed': 0, 'unreachable': 0}
+    summary_lock = threading.Lock()
+
+    def run_chunk(host, chunk):
+        # waits for the device first, so a chunk waiting for a slow device doesnt hold a slot the other devices could use
+        device_limiter.wait(host)
+        with slots:
+            started = time.monotonic()
+            try:
+                results = execute(host, chunk)
+            except Exception as error:
+                results = failed_results(host, error)
+            device_limiter.release(host, 'play', time.monotonic() - started, len(chunk), succeeded(host, results))
+        with summary_lock:
+            summary['tasks'] += len(chunk)
+        return results
+
+    # returns the outcome for the device: 'ok', 'failed' or 'unreachable'
+    def sync_device(host, phases):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=device_concurrency) as chunks:
+            for phase in phases:
+                futures = [chunks.submit(run_chunk, host, phase[i:i + SYNC_CHUNK_SIZE])
+                           for i in range(0, len(phase), SYNC_CHUNK_SIZE)]
+                results = [future.result() for future in futures]
+                # the next phase depends on this one
+                for outcome in ('unreachable', 'failed'):
+                    if any(host in result[outcome] for result in results):
+                        return outcome
+        return 'ok'
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as devices:
+        futures = [devices.submit(sync_device, host, phases) for host, phases in tasks.items()]
+        for future in futures:
+            summary[future.result()] += 1
+        # the pending saves are executed right away instead of waiting for the quiet window
+        save_debouncer.flush(devices)
+
+    elapsed = max(time.monotonic() - started, 0.001)
+    summary['seconds'] = round(elapsed, 1)
+    print('SYNC SUMMARY *********')
+    print(f"devices: {summary['devices']} ({summary['ok']} ok, {summary['failed']} failed, {summary['unreachable']} unreachable)")
+    print(f"tasks: {summary['tasks']} in {elapsed:.1f} s, {summary['tasks'] / elapsed:.1f} tasks/s, {summary['devices'] / elapsed:.1f} devices/s")
+    return summary
+
+
+start_workers()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OmniConf - configures devices according to Netbox')
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='listen for webhooks from Netbox (default)')
+    serve.add_argument('--host', default='0.0.0.0')
+    serve.add_argument('--port', type=int, default=5000)
+    serve.add_argument('--asgi', action='store_true', help='serve the asgi app with uvicorn instead of the flask app')
+    serve.add_argument('--shards', type=int, default=0, help='number of shard processes to start on the following ports')
+    shard = commands.add_parser('shard', help='execute the tasks for the devices a router sends to this process')
+    shard.add_argument('--host', default='0.0.0.0')
+    shard.add_argument('--port', type=int, default=5101)
+    shard.add_argument('--router', required=True, help='url of the process receiving the webhooks, e.g. http://10.0.0.1:5000')
+    shard.add_argument('--advertise', help='url the router reaches this shard on (default: http://<fqdn>:<port>)')
+    shard.add_argument('--executor', choices=sorted(executors), default=EXECUTOR)
+    shard.add_argument('--inventory', default=ANSIBLE_INVFILE, help='path to the Ansible inventory file')
+    sync = commands.add_parser('sync', help='bring every device in line with Netbox and exit')
+    sync.add_argument('--site', help='only sync the devices of this site (slug)')
+    sync.add_argument('--concurrency', type=int, default=SYNC_CONCURRENCY, help='max number of plays at the same time')
+    sync.add_argument('--device-concurrency', type=int, default=SYNC_DEVICE_CONCURRENCY, help='max number of plays at the same time per device')
+    sync.add_argument('--executor', choices=sorted(executors), default=EXECUTOR)
+    args = parser.parse_args()
+
+    # the local shards get the token from the router, a shard started by hand must have it in the settings or the environment
+    SHARD_TOKEN = SHARD_TOKEN or os.environ.get('OMNICONF_SHARD_TOKEN', '')
+    if args.command == 'serve' and args.shards:
+        SHARD_TOKEN = SHARD_TOKEN or secrets.token_hex(16)
+    if args.command == 'shard' or (args.command == 'serve' and args.shards):
+        try:
+            enable_sharding()
+        except RuntimeError as error:
+            sys.exit(str(error))
+
+    if args.command == 'serve' and args.shards:
+        # the local shards join the router once it is listening, until then the tasks are executed by the router
+        for i in range(1, args.shards + 1):
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'shard', '--host', '127.0.0.1', '--port', str(args.port + i),
+                                        '--router', f'http://127.0.0.1:{args.port}', '--advertise', f'http://127.0.0.1:{args.port + i}'],
+                                       env=dict(os.environ, OMNICONF_SHARD_TOKEN=SHARD_TOKEN))
+            atexit.register(process.terminate)
+
+    if args.command == 'sync':
+        EXECUTOR = args.executor
+        sync_netbox(args.site, args.concurrency, args.device_concurrency)
+    elif args.command == 'shard':
+        EXECUTOR = args.executor
+        ansible_runtime.sources = args.inventory
+        url = args.advertise or f'http://{socket.getfqdn()}:{args.port}'
+
+        # joins the router as soon as both are listening and keeps telling it the shard is there, and leaves it when stopped
+        def join():
+            while True:
+                try:
+                    shard_session.post(args.router + SHARD_PATH + '/join', data=json.dumps({'url': url}), headers=shard_headers(),
+                                       timeout=HTTP_TIMEOUT).raise_for_status()
+                    time.sleep(SHARD_HEARTBEAT)
+                except requests.RequestException:
+                    time.sleep(1)
+
+        def leave():
+            try:
+                shard_session.post(args.router + SHARD_PATH + '/leave', data=json.dumps({'url': url}), headers=shard_headers(), timeout=HTTP_TIMEOUT)
+            except requests.RequestException:
+                pass
+
+        # the inventory and var files are loaded before any tasks are sent to the shard
+        with ansible_runtime.use():
+            pass
+        threading.Thread(target=join, name='omniconf-shard-join', daemon=True).start()
+        atexit.register(leave)
+        app.run(host=args.host, port=args.port, threaded=True)
+    elif args.command == 'serve' and args.asgi:
+        import uvicorn
+        uvicorn.run(asgi_app, host=args.host, port=args.port, lifespan='on')
+    else:
+        # replays the unfinished jobs and loads the index right away, instead of when the first webhook is received
+        journal.open()
+        netbox_index.start()
+        app.run(host=args.host, port=args.port)
@@ -0,0 +1,333 @@
+# unit tests of OmniConf that need neither Netbox, Ansible nor devices
+# run with "python -m unittest" or "python -m pytest"
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import requests
+
+import main
+
+
+DEVICE = {'id': 1, 'url': '/api/dcim/devices/1/', 'name': 'switch 1'}
+INTERFACE = {'id': 7, 'url': '/api/dcim/interfaces/7/', 'name': 'Loopback7', 'device': DEVICE}
+
+
+def interface_webhook(event, prechange, postchange, name='Loopback7'):
+    data = {'id': 7, 'url': '/api/dcim/interfaces/7/', 'device': DEVICE, 'name': name,
+            'type': {'value': 'virtual', 'label': 'Virtual'}, 'enabled': True, 'description': ''}
+    return {'event': event, 'model': 'interface', 'data': data, 'snapshots': {'prechange': prechange, 'postchange': postchange}}
+
+
+def interface_snapshot(description, enabled=True, name='Loopback7'):
+    return {'device': 1, 'name': name, 'type': 'virtual', 'enabled': enabled, 'description': description}
+
+
+def address_webhook(event, prechange, postchange, address):
+    data = {'id': 3, 'url': '/api/ipam/ip-addresses/3/', 'family': {'value': 4, 'label': 'IPv4'}, 'address': address,
+            'assigned_object_type': 'dcim.interface', 'assigned_object_id': 7, 'assigned_object': INTERFACE}
+    return {'event': event, 'model': 'ipaddress', 'data': data, 'snapshots': {'prechange': prechange, 'postchange': postchange}}
+
+
+def address_snapshot(address):
+    return {'address': address, 'assigned_object_type': 40, 'assigned_object_id': 7, 'status': 'active'}
+
+
+# the (job, tasks) entries the coalescer gathers for the webhooks
+def entries(*webhooks):
+    gathered = []
+    for webhook in webhooks:
+        job = main.translate(webhook)
+        gathered.append((job, main.build_tasks(job['config'], job['event'], job['model'], job['data'], job['prechange'])))
+    return gathered
+
+
+# the method, path and content of the tasks
+def requests_of(tasks):
+    return [(task['action']['args']['method'], task['action']['args']['path'],
+             json.loads(task['action']['args']['content']) if 'content' in task['action']['args'] else None) for task in tasks]
+
+
+class CompactJobsTest(unittest.TestCase):
+
+    def test_created_and_updated_becomes_created_with_final_values(self):
+        tasks, folded = main.compact_jobs(entries(
+            interface_webhook('created', None, interface_snapshot('first')),
+            interface_webhook('updated', interface_snapshot('first'), interface_snapshot('second', enabled=False))))
+
+        self.assertEqual(folded, 1)
+        self.assertEqual(requests_of(tasks), [('post', '/data/ietf-interfaces:interfaces',
+                                               {'ietf-interfaces:interface': {'name': 'Loopback7', 'type': 'softwareLoopback',
+                                                                              'enabled': False, 'description': 'second'}})])
+
+    def test_updated_and_updated_merges_the_changes(self):
+        tasks, folded = main.compact_jobs(entries(
+            interface_webhook('updated', interface_snapshot('first'), interface_snapshot('second')),
+            interface_webhook('updated', interface_snapshot('second'), interface_snapshot('second', enabled=False))))
+
+        self.assertEqual(folded, 1)
+        self.assertEqual(requests_of(tasks), [('patch', '/data/ietf-interfaces:interfaces/interface=Loopback7',
+                                               {'ietf-interfaces:interface:': {'description': 'second', 'enabled': False}})])
+
+    def test_updated_and_updated_address_removes_the_address_the_device_has(self):
+        tasks, folded = main.compact_jobs(entries(
+            address_webhook('updated', address_snapshot('10.0.0.1/24'), address_snapshot('10.0.0.2/24'), '10.0.0.2/24'),
+            address_webhook('updated', address_snapshot('10.0.0.2/24'), address_snapshot('10.0.0.3/24'), '10.0.0.3/24')))
+
+        self.assertEqual(folded, 1)
+        self.assertEqual([(method, path) for method, path, content in requests_of(tasks)],
+                         [('delete', '/data/ietf-interfaces:interfaces/interface=Loopback7/ietf-ip:ipv4/address=10.0.0.1'),
+                          ('patch', '/data/ietf-interfaces:interfaces/interface=Loopback7')])
+        self.assertEqual(requests_of(tasks)[1][2]['ietf-interfaces:interface']['ietf-ip:ipv4']['address'][0]['ip'], '10.0.0.3')
+
+    def test_created_and_deleted_cancel_out(self):
+        tasks, folded = main.compact_jobs(entries(
+            interface_webhook('created', None, interface_snapshot('first')),
+            interface_webhook('deleted', interface_snapshot('first'), None)))
+
+        self.assertEqual(folded, 2)
+        self.assertEqual(tasks, [])
+
+    def test_updated_and_deleted_address_deletes_the_address_the_device_has(self):
+        tasks, folded = main.compact_jobs(entries(
+            address_webhook('updated', address_snapshot('10.0.0.1/24'), address_snapshot('10.0.0.2/24'), '10.0.0.2/24'),
+            address_webhook('deleted', address_snapshot('10.0.0.2/24'), None, '10.0.0.2/24')))
+
+        self.assertEqual(folded, 1)
+        self.assertEqual(requests_of(tasks), [('delete', '/data/ietf-interfaces:interfaces/interface=Loopback7/ietf-ip:ipv4/address=10.0.0.1', None)])
+
+    def test_renamed_and_deleted_interface_deletes_the_old_name(self):
+        tasks, folded = main.compact_jobs(entries(
+            interface_webhook('updated', interface_snapshot('first'), interface_snapshot('first', name='Loopback8'), name='Loopback8'),
+            interface_webhook('deleted', interface_snapshot('first', name='Loopback8'), None, name='Loopback8')))
+
+        self.assertEqual(folded, 1)
+        self.assertEqual(requests_of(tasks), [('delete', '/data/ietf-interfaces:interfaces/interface=Loopback7', None)])
+
+    def test_other_objects_are_kept_in_order(self):
+        gathered = entries(
+            interface_webhook('updated', interface_snapshot('first'), interface_snapshot('second')),
+            address_webhook('created', None, address_snapshot('10.0.0.1/24'), '10.0.0.1/24'))
+        tasks, folded = main.compact_jobs(gathered)
+
+        self.assertEqual(folded, 0)
+        self.assertEqual(tasks, gathered[0][1] + gathered[1][1])
+
+
+class YangPatchEditTest(unittest.TestCase):
+
+    def test_interface_update_is_a_merge_of_the_keyed_entry(self):
+        task = entries(interface_webhook('updated', interface_snapshot('first'), interface_snapshot('second'),
+                                         name='GigabitEthernet1/0/1'))[0][1][0]
+
+        self.assertEqual(main.yang_patch_edit('1', task['action']['args']),
+                         {'edit-id': '1', 'operation': 'merge', 'target': '/ietf-interfaces:interfaces/interface=GigabitEthernet1%2F0%2F1',
+                          'value': {'ietf-interfaces:interface': [{'name': 'GigabitEthernet1/0/1', 'description': 'second'}]}})
+
+    def test_address_is_merged_into_the_keyed_interface(self):
+        task = entries(address_webhook('created', None, address_snapshot('10.0.0.1/24'), '10.0.0.1/24'))[0][1][0]
+        edit = main.yang_patch_edit('1', task['action']['args'])
+
+        self.assertEqual(edit['target'], '/ietf-interfaces:interfaces/interface=Loopback7')
+        self.assertEqual(list(edit['value']), ['ietf-interfaces:interface'])
+        self.assertEqual(edit['value']['ietf-interfaces:interface'][0]['name'], 'Loopback7')
+        self.assertEqual(edit['value']['ietf-interfaces:interface'][0]['ietf-ip:ipv4']['address'][0]['ip'], '10.0.0.1')
+
+    def test_created_interface_is_created_at_its_entry(self):
+        task = entries(interface_webhook('created', None, interface_snapshot('first')))[0][1][0]
+        edit = main.yang_patch_edit('1', task['action']['args'])
+
+        self.assertEqual((edit['operation'], edit['target']), ('create', '/ietf-interfaces:interfaces/interface=Loopback7'))
+        self.assertEqual(edit['value']['ietf-interfaces:interface'][0]['name'], 'Loopback7')
+
+
+class DeviceLimiterTest(unittest.TestCase):
+
+    def test_wait_blocks_until_the_device_has_room_without_the_worker_pool(self):
+        limiter = main.DeviceLimiter(0, 0, 1, 1, 3, 0)
+        limiter.wait('switch 1')
+        started = time.monotonic()
+        threading.Timer(0.2, limiter.release, ('switch 1', 'play', 0.1, 1, True)).start()
+        limiter.wait('switch 1')
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        self.assertEqual(limiter.stats()['running'], 1)
+        self.assertEqual(limiter.thread, None)
+
+    def test_wait_keeps_to_the_rate(self):
+        limiter = main.DeviceLimiter(10, 10, 5, 5, 3, 0)
+        started = time.monotonic()
+        for i in range(3):
+            limiter.wait('switch 1')
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+
+class SaveDebouncerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = main.DeviceLimiter(0, 0, 1, 1, 3, 0)
+        self.breaker = main.CircuitBreaker(3, 3600, 3600, lambda host: False)
+        response = requests.Response()
+        response.status_code = 500
+        response._content = json.dumps({'ietf-restconf:errors': {'error': [{'error-tag': 'operation-failed'}]}}).encode()
+        sessions = unittest.mock.Mock()
+        sessions.get.return_value.post.return_value = response
+        patchers = [unittest.mock.patch.object(main, 'device_limiter', self.limiter),
+                    unittest.mock.patch.object(main, 'breaker', self.breaker),
+                    unittest.mock.patch.object(main, 'device_sessions', sessions),
+                    unittest.mock.patch.object(main, 'device_connection', lambda host: (f'https://{host}/restconf', None))]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_refused_save_is_a_failed_save(self):
+        debouncer = main.SaveDebouncer(0, 0, main.save_config)
+        self.limiter.wait('192.0.2.1')
+
+        debouncer.run_admitted('192.0.2.1')
+
+        self.assertEqual(debouncer.stats()['saved'], 0)
+        self.assertEqual(self.limiter.stats()['lowered'], 1)
+        self.assertEqual(self.breaker.stats()['parked'], 1)
+
+
+class NetboxIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = main.NetboxIndex(60)
+        self.cache = main.PrimaryIPCache(10, 60)
+        patcher = unittest.mock.patch.object(main, 'ip_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def load(self, since, devices, addresses=()):
+        pages = {'/api/dcim/devices/': devices, '/api/ipam/ip-addresses/': addresses}
+        with unittest.mock.patch.object(main, 'netbox_pages', lambda path, params: iter(pages[path])):
+            self.index.load(since)
+
+    def test_refresh_removes_the_changed_primary_ip_from_the_cache(self):
+        self.cache.set('/api/dcim/devices/1/', '10.0.0.1/24')
+        self.cache.set('/api/dcim/devices/2/', '10.0.0.2/24')
+        self.load(None, [{'url': 'https://netbox/api/dcim/devices/1/', 'primary_ip': {'id': 1, 'address': '10.0.0.1/24'}},
+                         {'url': 'https://netbox/api/dcim/devices/2/', 'primary_ip': {'id': 2, 'address': '10.0.0.2/24'}}])
+        self.cache.set('/api/dcim/devices/1/', '10.0.0.1/24')
+        self.cache.set('/api/dcim/devices/2/', '10.0.0.2/24')
+
+        self.load(0, [{'url': 'https://netbox/api/dcim/devices/1/', 'primary_ip': {'id': 3, 'address': '10.0.0.3/24'}}],
+                  [{'id': 2, 'address': '10.0.0.4/24'}])
+
+        self.assertEqual(self.cache.get('/api/dcim/devices/1/'), (False, None))
+        self.assertEqual(self.cache.get('/api/dcim/devices/2/'), (False, None))
+        self.assertEqual(self.index.get('/api/dcim/devices/1/'), (True, '10.0.0.3/24'))
+        self.assertEqual(self.index.get('/api/dcim/devices/2/'), (True, '10.0.0.4/24'))
+
+    def test_refresh_keeps_the_unchanged_primary_ip_in_the_cache(self):
+        device = {'url': 'https://netbox/api/dcim/devices/1/', 'primary_ip': {'id': 1, 'address': '10.0.0.1/24'}}
+        self.load(None, [device])
+        self.cache.set('/api/dcim/devices/1/', '10.0.0.1/24')
+
+        self.load(0, [device], [{'id': 1, 'address': '10.0.0.1/24'}])
+
+        self.assertEqual(self.cache.get('/api/dcim/devices/1/'), (True, '10.0.0.1/24'))
+
+
+class SyncTasksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = []
+        self.pages = {
+            '/api/dcim/devices/': [{'id': 1, 'url': 'https://netbox/api/dcim/devices/1/', 'name': 'switch 1',
+                                    'primary_ip': {'id': 9, 'address': '192.0.2.1/24'}}],
+            '/api/dcim/interfaces/': [{'id': 7, 'url': 'https://netbox/api/dcim/interfaces/7/', 'device': DEVICE, 'name': 'Loopback7',
+                                       'type': {'value': 'virtual', 'label': 'Virtual'}, 'enabled': True, 'description': 'first'}],
+            '/api/ipam/ip-addresses/': [dict(address_webhook('created', None, None, '10.0.0.1/24')['data'], status={'value': 'active', 'label': 'Active'})],
+        }
+        patchers = [unittest.mock.patch.object(main, 'netbox_pages', self.netbox_pages),
+                    unittest.mock.patch.object(main, 'ip_cache', main.PrimaryIPCache(10, 60))]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def netbox_pages(self, path, params):
+        self.queries.append((path, params))
+        return iter(self.pages[path])
+
+    def test_interfaces_are_merged_so_missing_ones_are_created(self):
+        phases = main.sync_tasks()['192.0.2.1']
+
+        self.assertEqual(requests_of(phases[0][1:]), [('patch', '/data/ietf-interfaces:interfaces',
+                                                   {'ietf-interfaces:interfaces': {'interface': [{'name': 'Loopback7', 'type': 'softwareLoopback',
+                                                                                                  'enabled': True, 'description': 'first'}]}})])
+        self.assertEqual(main.describe_task(phases[0][1])[:2], ('interface', 'Loopback7'))
+        self.assertEqual(main.yang_patch_edit('1', phases[0][1]['action']['args'])['operation'], 'merge')
+
+    def test_site_filters_the_ip_addresses_by_its_devices(self):
+        main.sync_tasks('site-1')
+
+        self.assertEqual(self.queries[-1], ('/api/ipam/ip-addresses/', {'assigned_to_interface': 'true', 'device_id': [1]}))
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = main.Journal(os.path.join(directory.name, 'journal.db'), 3600)
+        self.journal.open()
+        self.addCleanup(self.journal.connection.close)
+        # the jobs appended during the replay would be replayed by it
+        while self.journal.recovering:
+            time.sleep(0.01)
+        patchers = [unittest.mock.patch.object(main, 'journal', self.journal),
+                    unittest.mock.patch.object(main, 'job_listeners', [self.journal.finish])]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def status(self, job):
+        with self.journal.lock:
+            return self.journal.connection.execute('SELECT status FROM jobs WHERE id = ?', (job['journal'],)).fetchone()[0]
+
+    def test_job_is_failed_when_netbox_cant_be_asked_for_the_device(self):
+        webhook = interface_webhook('updated', interface_snapshot('first'), interface_snapshot('second'))
+        job = main.translate(webhook)
+        self.journal.append(json.dumps(webhook), job)
+
+        with unittest.mock.patch.object(main, 'get_api_data', unittest.mock.Mock(side_effect=ConnectionError('netbox is down'))):
+            with self.assertRaises(ConnectionError):
+                main.process_job(job)
+
+        self.assertEqual(self.status(job), 'failed')
+
+    def test_job_is_failed_when_its_tasks_cant_be_created(self):
+        # an unnamed device that gets a primary ip, its hostname cant be built
+        webhook = {'event': 'updated', 'model': 'device',
+                   'data': {'id': 1, 'url': '/api/dcim/devices/1/', 'name': None,
+                            'primary_ip': {'id': 9, 'address': '192.0.2.1/24'}, 'primary_ip4': {'id': 9, 'address': '192.0.2.1/24'}},
+                   'snapshots': {'prechange': {'name': None, 'primary_ip4': None}, 'postchange': {'name': None, 'primary_ip4': 9}}}
+        job = main.translate(webhook)
+        self.journal.append(json.dumps(webhook), job)
+
+        with self.assertRaises(AttributeError):
+            main.process_job(job)
+
+        self.assertEqual(self.status(job), 'failed')
+
+    def test_job_without_tasks_is_done(self):
+        webhook = interface_webhook('updated', interface_snapshot('first'), interface_snapshot('second'))
+        job = main.translate(webhook)
+        self.journal.append(json.dumps(webhook), job)
+
+        main.finish_jobs([job], None)
+
+        self.assertEqual(self.status(job), 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()